@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+"""Local stand-ins for the yousee EPG server and the state monitor, for benchmarks.
+
+The EPG server serves synthetic EPG XML of any size, without holding it in
+memory: the document is a header, fixed-length programme elements and a
+footer, so any byte range can be generated on demand. It can add latency
+before each response and limit the bandwidth, and optionally answers
+conditional requests with 304, compresses with gzip and serves byte ranges.
+
+The state monitor accepts states like the real one, and remembers when each
+arrived, so the time spent in each component of a run can be derived from them.
+
+Run it on its own with
+
+    bench/epgserver.py --size 100M --latency 0.05 --bandwidth 10M --gzip
+"""
+
+import BaseHTTPServer, SocketServer, threading, time, zlib
+from email.utils import formatdate
+from optparse import OptionParser
+from urllib import unquote
+
+header = "<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n<tv generator-info-name=\"bench\">\n"
+footer = "</tv>\n"
+recordLength = 256
+recordFormat = "<programme start=\"%010i\" channel=\"ch%05i\"><title>Programme %010i</title><desc>%s</desc></programme>\n"
+chunkSize = 64 * 1024
+
+def parseSize(size):
+    """Parse a size like "512", "10K", "100M" or "1G" into bytes."""
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+    size = str(size).strip().upper()
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+class SyntheticEpg():
+    """A well-formed EPG document of exactly size bytes, generated a range at a time."""
+
+    def __init__(self, size, version=1):
+        self.size = max(size, len(header) + len(footer))
+        self.version = version
+        self.records = (self.size - len(header) - len(footer)) // recordLength
+        # whitespace fills the gap between the last programme and the footer
+        self.padding = self.size - len(header) - len(footer) - self.records * recordLength
+        self.bodyStart = len(header)
+        self.footerStart = self.bodyStart + self.records * recordLength + self.padding
+        self.compressed = None
+
+
+    def _record(self, i):
+        record = recordFormat % (i * 300, i % 100, i + self.version, "")
+        return record.replace("</desc>", "." * (recordLength - len(record)) + "</desc>", 1)
+
+
+    def read(self, start, end):
+        """Get the bytes from start up to, but not including, end."""
+        parts = []
+        position = start
+
+        if position < self.bodyStart:
+            parts.append(header[position:min(end, self.bodyStart)])
+            position = min(end, self.bodyStart)
+
+        recordsEnd = self.bodyStart + self.records * recordLength
+        if position < min(end, recordsEnd):
+            first = (position - self.bodyStart) // recordLength
+            last = (min(end, recordsEnd) - self.bodyStart - 1) // recordLength
+            records = "".join(self._record(i) for i in range(first, last + 1))
+            offset = self.bodyStart + first * recordLength
+            parts.append(records[position - offset:min(end, recordsEnd) - offset])
+            position = min(end, recordsEnd)
+
+        if position < min(end, self.footerStart):
+            parts.append(" " * (min(end, self.footerStart) - position))
+            position = min(end, self.footerStart)
+
+        if position < end:
+            parts.append(footer[position - self.footerStart:end - self.footerStart])
+
+        return "".join(parts)
+
+
+    def chunks(self, start=0, end=None):
+        end = self.size if end is None else end
+        for position in xrange(start, end, chunkSize):
+            yield self.read(position, min(position + chunkSize, end))
+
+
+    def getCompressed(self):
+        """The whole document gzipped, compressed once and kept, since the gzip stream can't be generated a range at a time."""
+        if self.compressed is None:
+            compressor = zlib.compressobj(1, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self.compressed = "".join([compressor.compress(chunk) for chunk in self.chunks()] + [compressor.flush()])
+        return self.compressed
+
+
+    def getEtag(self, encoding=None):
+        if encoding:
+            return "\"bench-%i-%i-%s\"" % (self.size, self.version, encoding)
+        return "\"bench-%i-%i\"" % (self.size, self.version)
+
+
+    def getLastModified(self):
+        return formatdate(1000000000 + self.version * 3600, usegmt=True)
+
+
+class EpgServerStats():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.notModified = 0
+        self.partial = 0
+        self.bytesSent = 0
+
+
+    def add(self, **counts):
+        with self.lock:
+            for key, value in counts.items():
+                setattr(self, key, getattr(self, key) + value)
+
+
+class EpgHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # otherwise every response waits for the client's delayed ACK of the status line
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+
+    def _write(self, data):
+        """Write data, no faster than the bandwidth of the server."""
+        bandwidth = self.server.bandwidth
+        for position in xrange(0, len(data), chunkSize):
+            chunk = data[position:position + chunkSize]
+            started = time.time()
+            self.wfile.write(chunk)
+            self.server.stats.add(bytesSent=len(chunk))
+            if bandwidth:
+                time.sleep(max(len(chunk) / float(bandwidth) - (time.time() - started), 0))
+
+
+    def _sendHeaders(self, status, length, headers={}, etag=None):
+        epg = self.server.epg
+        self.send_response(status)
+        self.send_header("Content-Length", str(length))
+        self.send_header("ETag", etag or epg.getEtag())
+        self.send_header("Last-Modified", epg.getLastModified())
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+
+
+    def do_GET(self):
+        server = self.server
+        epg = server.epg
+        server.stats.add(requests=1)
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        if server.notModified and (self.headers.get("If-None-Match") in [epg.getEtag(), epg.getEtag("gzip")] or
+                                   self.headers.get("If-Modified-Since") == epg.getLastModified()):
+            server.stats.add(notModified=1)
+            self._sendHeaders(304, 0)
+            return
+
+        rangeHeader = self.headers.get("Range", "")
+        ifRange = self.headers.get("If-Range")
+        if server.ranges and rangeHeader.startswith("bytes=") and ifRange in [None, epg.getEtag(), epg.getLastModified()]:
+            start, end = rangeHeader[len("bytes="):].split("-")
+            start, end = int(start), int(end) + 1 if end else epg.size
+            if start >= epg.size:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */%i" % epg.size)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+            server.stats.add(partial=1)
+            self._sendHeaders(206, end - start, {"Content-Range": "bytes %i-%i/%i" % (start, end - 1, epg.size)})
+            for chunk in epg.chunks(start, end):
+                self._write(chunk)
+            return
+
+        if server.gzip and "gzip" in self.headers.get("Accept-Encoding", ""):
+            compressed = epg.getCompressed()
+            # the etag of the compressed representation differs from the uncompressed one
+            self._sendHeaders(200, len(compressed), {"Content-Encoding": "gzip"}, epg.getEtag("gzip"))
+            self._write(compressed)
+            return
+
+        self._sendHeaders(200, epg.size)
+        for chunk in epg.chunks():
+            self._write(chunk)
+
+
+class StateMonitorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        # /<monitor>/states/<entity>
+        entity = unquote(self.path.rsplit("/", 1)[-1])
+        self.server.addState(entity, data)
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write("{}")
+
+
+class ThreadingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class EpgServer(ThreadingServer):
+    def __init__(self, address, epg, latency=0, bandwidth=0, notModified=True, gzip=False, ranges=True):
+        ThreadingServer.__init__(self, address, EpgHandler)
+        self.epg = epg
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.notModified = notModified
+        self.gzip = gzip
+        self.ranges = ranges
+        self.stats = EpgServerStats()
+
+
+class StateMonitorServer(ThreadingServer):
+    def __init__(self, address, latency=0):
+        ThreadingServer.__init__(self, address, StateMonitorHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.states = []
+        self.bytesReceived = 0
+
+
+    def addState(self, entity, data):
+        with self.lock:
+            self.states.append((time.time(), entity, data))
+            self.bytesReceived += len(data)
+
+
+    def reset(self):
+        with self.lock:
+            self.states = []
+            self.bytesReceived = 0
+
+
+def startServer(server):
+    """Serve from a background thread, returning the url of the server."""
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return "http://%s:%i" % server.server_address
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--port", type="int", default=18080, help="port of the EPG server; the state monitor uses the next one")
+    parser.add_option("--size", default="8M", help="size of the EPG document, e.g. 1M or 1G (default 8M)")
+    parser.add_option("--latency", type="float", default=0, help="seconds before each response")
+    parser.add_option("--bandwidth", default="0", help="bytes per second per connection, e.g. 10M; 0 is unlimited")
+    parser.add_option("--gzip", action="store_true", help="compress responses, when asked to")
+    parser.add_option("--no-304", dest="notModified", action="store_false", default=True, help="ignore conditional requests")
+    parser.add_option("--no-ranges", dest="ranges", action="store_false", default=True, help="ignore range requests")
+    (options, args) = parser.parse_args()
+
+    epgServer = EpgServer(("127.0.0.1", options.port), SyntheticEpg(parseSize(options.size)), options.latency,
+                          parseSize(options.bandwidth), options.notModified, options.gzip, options.ranges)
+    stateMonitor = StateMonitorServer(("127.0.0.1", options.port + 1))
+    print "EPG server at %s/epg.xml" % startServer(epgServer)
+    print "State monitor at %s/workflowstatemonitor" % startServer(stateMonitor)
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""Benchmark the downloader end to end against the local stand-ins in epgserver.py.
+
+Every combination of the given sizes and fetch backends is a scenario. Each
+scenario gets its own servers and data directory, and the downloader is run
+as a separate process, --runs times in a row; the runs after the first show
+what an unchanged EPG costs. For every run, the wall time of each stage is
+taken from when its states reached the state monitor, the peak RSS from the
+rusage of the process (including wget), and the bytes from the servers and
+the data directory.
+
+Usage: run.py [options]
+
+    bench/run.py --size 1M,100M,1G --backend wget,http --runs 2
+    bench/run.py --size 100M --backend http --gzip --bandwidth 20M --json results.jsonl
+"""
+
+import os, sys, json, shutil, subprocess, tempfile, time
+from optparse import OptionParser
+from epgserver import EpgServer, StateMonitorServer, SyntheticEpg, parseSize, startServer
+
+repoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+downloaderScript = os.path.join(repoDir, "lib", "yousee-epg-downloader.py")
+
+def createConfig(workDir, epgUrl, stateMonitorUrl, size, backend, extra):
+    config = {
+        "Username": "bench",
+        "Password": "bench",
+        "EpgUrl": epgUrl,
+        "DataDir": os.path.join(workDir, "data"),
+        "TrashDir": os.path.join(workDir, "trash"),
+        "LogFile": os.path.join(workDir, "log"),
+        "LogFileMaxSize": -1,
+        "OldLogFiles": 0,
+        "StateMonitor": stateMonitorUrl,
+        "EpgAgeLimit": 24,
+        "EpgAgeLimitWiggleRoom": 1,
+        "EpgMinSize": 0,
+        "EpgMaxSize": size * 2 + 1024 ** 2,
+        "FetchBackend": backend,
+        "FetchRetryDelay": 0,
+    }
+    config.update(extra)
+    os.mkdir(config["DataDir"])
+
+    path = os.path.join(workDir, "config.json")
+    with open(path, "w") as f:
+        json.dump(config, f, indent=4)
+    return path, config
+
+
+def getStoredBytes(dataDir):
+    """Get the total size of the EPG files in the data directory, leaving out hidden files."""
+    total = 0
+    for root, dirs, files in os.walk(dataDir):
+        total += sum(os.path.getsize(os.path.join(root, f)) for f in files if not f.startswith("."))
+    return total
+
+
+def getStages(states):
+    """Get (component, state, seconds) for every component in states, in the order they started."""
+    started = {}
+    stages = []
+
+    for arrived, entity, data in states:
+        component = data.split("<component>", 1)[1].split("</component>", 1)[0]
+        state = data.split("<stateName>", 1)[1].split("</stateName>", 1)[0]
+        if state == "Started":
+            started[component] = arrived
+            stages.append([component, None, None])
+        else:
+            for stage in stages:
+                if stage[0] == component and stage[1] is None:
+                    stage[1] = state
+                    stage[2] = arrived - started[component]
+                    break
+            else:
+                # a component that was only reported once, e.g. a missing EPG
+                stages.append([component, state, 0.0])
+
+    return [tuple(stage) for stage in stages]
+
+
+def runOnce(configPath, epgServer, stateMonitor, dataDir):
+    stateMonitor.reset()
+    sentBefore = epgServer.stats.bytesSent
+    storedBefore = getStoredBytes(dataDir)
+
+    started = time.time()
+    process = subprocess.Popen([sys.executable, downloaderScript, configPath])
+    pid, status, rusage = os.wait4(process.pid, 0)
+    wall = time.time() - started
+
+    return {
+        "exitCode": os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status),
+        "wall": wall,
+        "cpu": rusage.ru_utime + rusage.ru_stime,
+        # kilobytes on Linux
+        "peakRss": rusage.ru_maxrss * 1024,
+        "bytesServed": epgServer.stats.bytesSent - sentBefore,
+        "bytesStored": getStoredBytes(dataDir) - storedBefore,
+        "states": len(stateMonitor.states),
+        "stateBytes": stateMonitor.bytesReceived,
+        "stages": getStages(stateMonitor.states),
+    }
+
+
+def runScenario(options, size, backend):
+    workDir = tempfile.mkdtemp(prefix="yousee-epg-bench-")
+    epgServer = EpgServer(("127.0.0.1", 0), SyntheticEpg(size), options.latency, parseSize(options.bandwidth),
+                          options.notModified, options.gzip, options.ranges)
+    stateMonitor = StateMonitorServer(("127.0.0.1", 0), options.stateLatency)
+    extra = json.loads(options.config) if options.config else {}
+
+    try:
+        configPath, config = createConfig(workDir, startServer(epgServer) + "/epg.xml", startServer(stateMonitor) + "/workflowstatemonitor",
+                                          size, backend, extra)
+        if options.gzip:
+            # compressed once up front, so the first run doesn't pay for it
+            epgServer.epg.getCompressed()
+
+        results = []
+        for run in range(1, options.runs + 1):
+            result = runOnce(configPath, epgServer, stateMonitor, config["DataDir"])
+            result.update({"size": size, "backend": backend, "run": run, "gzip": bool(options.gzip),
+                           "latency": options.latency, "bandwidth": parseSize(options.bandwidth), "time": time.time()})
+            results.append(result)
+        return results
+    finally:
+        epgServer.shutdown()
+        stateMonitor.shutdown()
+        epgServer.server_close()
+        stateMonitor.server_close()
+        if options.keep:
+            print "Kept \"%s\"." % workDir
+        else:
+            shutil.rmtree(workDir)
+
+
+def prettyBytes(count):
+    return "%.1f MB" % (count / 1024.0 / 1024.0)
+
+
+def report(result):
+    print "%s %s%s, run %i: exit %i, wall %.3f s, cpu %.3f s, peak RSS %s, served %s, stored %s, %i states (%s)" % (
+        result["backend"], prettyBytes(result["size"]), " gzip" if result["gzip"] else "", result["run"], result["exitCode"],
+        result["wall"], result["cpu"], prettyBytes(result["peakRss"]), prettyBytes(result["bytesServed"]),
+        prettyBytes(result["bytesStored"]), result["states"], prettyBytes(result["stateBytes"]))
+    for component, state, seconds in result["stages"]:
+        print "    %-28s %-10s %8.3f s" % (component, state, seconds or 0.0)
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--size", default="1M,16M", help="comma separated EPG sizes, e.g. 1M,100M,1G (default 1M,16M)")
+    parser.add_option("--backend", default="wget,http", help="comma separated fetch backends (default wget,http)")
+    parser.add_option("--runs", type="int", default=2, help="runs per scenario (default 2)")
+    parser.add_option("--latency", type="float", default=0, help="seconds before each EPG response")
+    parser.add_option("--bandwidth", default="0", help="bytes per second for the EPG server, e.g. 10M; 0 is unlimited")
+    parser.add_option("--gzip", action="store_true", help="let the EPG server compress its responses")
+    parser.add_option("--no-304", dest="notModified", action="store_false", default=True, help="make the EPG server ignore conditional requests")
+    parser.add_option("--no-ranges", dest="ranges", action="store_false", default=True, help="make the EPG server ignore range requests")
+    parser.add_option("--state-latency", dest="stateLatency", type="float", default=0, help="seconds before each state monitor response")
+    parser.add_option("--config", help="json object of extra settings for the downloader, e.g. '{\"StateMonitorBackground\": true}'")
+    parser.add_option("--json", help="append the results to this file, one json object per run")
+    parser.add_option("--keep", action="store_true", help="keep the data directories and logs")
+    (options, args) = parser.parse_args()
+
+    for size in [parseSize(size) for size in options.size.split(",")]:
+        for backend in options.backend.split(","):
+            for result in runScenario(options, size, backend):
+                report(result)
+                if options.json:
+                    with open(options.json, "a") as f:
+                        f.write(json.dumps(result) + "\n")
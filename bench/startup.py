@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""Measure the cold-start time of the downloader: starting python, importing
+yousee-epg-downloader.py with everything it imports, and creating the filename
+of the run, which is what every cron run pays before doing any work.
+
+Usage: startup.py [-n runs] [git-revision ...]
+
+Without revisions, the working tree is measured. Each revision is exported
+with git archive into a temporary directory, so e.g.
+
+    bench/startup.py HEAD~1 HEAD
+
+compares the last commit with the one before it.
+"""
+
+import os, sys, shutil, subprocess, tempfile, time
+from optparse import OptionParser
+
+repoDir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# run in a fresh interpreter, so nothing is imported or cached beforehand
+startupCode = """
+import imp, sys
+sys.path.insert(0, %(libDir)r)
+imp.load_source("downloader", %(script)r)
+import misc
+misc.createFilename()
+"""
+
+
+def measure(libDir, runs):
+    """Return the wall times, in seconds, of runs cold starts using the code in libDir."""
+    code = startupCode % {"libDir": libDir, "script": os.path.join(libDir, "yousee-epg-downloader.py")}
+    times = []
+
+    for i in range(runs):
+        start = time.time()
+        subprocess.check_call([sys.executable, "-c", code])
+        times.append(time.time() - start)
+
+    return times
+
+
+def exportRevision(revision, targetDir):
+    archive = subprocess.Popen(["git", "archive", revision, "lib"], cwd=repoDir, stdout=subprocess.PIPE)
+    subprocess.check_call(["tar", "-x", "-C", targetDir], stdin=archive.stdout)
+    if archive.wait() != 0:
+        raise Exception("git archive failed for \"%s\"." % revision)
+    return os.path.join(targetDir, "lib")
+
+
+def report(name, times):
+    times = sorted(times)
+    median = times[len(times) // 2]
+    print "%-20s median %7.1f ms   min %7.1f ms   max %7.1f ms" % (name, median * 1000, times[0] * 1000, times[-1] * 1000)
+
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog [-n runs] [git-revision ...]")
+    parser.add_option("-n", "--runs", type="int", default=20, help="number of cold starts to measure (default 20)")
+    (options, revisions) = parser.parse_args()
+
+    if not revisions:
+        report("working tree", measure(os.path.join(repoDir, "lib"), options.runs))
+
+    for revision in revisions:
+        tmpDir = tempfile.mkdtemp()
+        try:
+            report(revision, measure(exportRevision(revision, tmpDir), options.runs))
+        finally:
+            shutil.rmtree(tmpDir)
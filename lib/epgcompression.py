@@ -0,0 +1,155 @@
+import zlib
+
+# suffixes of the files stored compressed, see StorageCompression
+compressionSuffixes = {"gzip": ".gz", "zstd": ".zst"}
+
+# brotli and zstd are only offered to the server when the modules are installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+class DecompressionError(Exception):
+    """Raised by every decompressor when the data is corrupt, whatever the module that found it."""
+    pass
+
+
+class ZlibDecompressor():
+    """Decompress gzip, zlib or raw deflate data, as selected by wbits."""
+
+    def __init__(self, wbits):
+        self.decompressor = zlib.decompressobj(wbits)
+
+
+    def decompress(self, chunk):
+        try:
+            return self.decompressor.decompress(chunk)
+        except zlib.error as e:
+            raise DecompressionError(str(e))
+
+
+    def flush(self):
+        try:
+            return self.decompressor.flush()
+        except zlib.error as e:
+            raise DecompressionError(str(e))
+
+
+class DeflateDecompressor():
+    """Decompress "deflate" data. Servers disagree on whether that means
+    zlib-wrapped or raw deflate data, so the first chunk decides.
+    """
+
+    def __init__(self):
+        self.decompressor = None
+
+
+    def decompress(self, chunk):
+        if self.decompressor is None:
+            self.decompressor = ZlibDecompressor(zlib.MAX_WBITS)
+            try:
+                return self.decompressor.decompress(chunk)
+            except DecompressionError:
+                self.decompressor = ZlibDecompressor(-zlib.MAX_WBITS)
+
+        return self.decompressor.decompress(chunk)
+
+
+    def flush(self):
+        if self.decompressor is None:
+            return ""
+        return self.decompressor.flush()
+
+
+class BrotliDecompressor():
+    def __init__(self):
+        self.decompressor = brotli.Decompressor()
+        # the brotli and brotlipy modules name the method differently
+        self.process = getattr(self.decompressor, "process", None) or self.decompressor.decompress
+        # and their exceptions too
+        self.error = getattr(brotli, "error", None) or brotli.Error
+
+
+    def decompress(self, chunk):
+        try:
+            return self.process(chunk)
+        except self.error as e:
+            raise DecompressionError(str(e))
+
+
+    def flush(self):
+        return ""
+
+
+class ZstdDecompressor():
+    def __init__(self):
+        self.decompressor = zstandard.ZstdDecompressor().decompressobj()
+
+
+    def decompress(self, chunk):
+        try:
+            return self.decompressor.decompress(chunk)
+        except zstandard.ZstdError as e:
+            raise DecompressionError(str(e))
+
+
+    def flush(self):
+        return ""
+
+
+def supportedEncodings():
+    """List the content encodings that can be decompressed, in order of preference."""
+    encodings = []
+    if zstandard:
+        encodings.append("zstd")
+    if brotli:
+        encodings.append("br")
+    return encodings + ["gzip", "deflate"]
+
+
+def createDecompressor(encoding):
+    """Create an incremental decompressor for encoding, which has a decompress(chunk) and a flush() method.
+    Both raise DecompressionError for corrupt data.
+    """
+    if encoding in ["gzip", "x-gzip"]:
+        # 16 makes zlib expect a gzip header
+        return ZlibDecompressor(16 + zlib.MAX_WBITS)
+    elif encoding == "deflate":
+        return DeflateDecompressor()
+    elif encoding == "br" and brotli:
+        return BrotliDecompressor()
+    elif encoding == "zstd" and zstandard:
+        return ZstdDecompressor()
+    else:
+        raise ValueError("Unsupported content encoding \"%s\"." % encoding)
+
+
+def createCompressor(compression, level=None):
+    """Create an incremental compressor for files stored with compression "gzip" or "zstd", which has a compress(chunk) and a flush() method."""
+    if compression == "gzip":
+        # 16 makes zlib write a gzip header, so the files can be read with zcat
+        return zlib.compressobj(6 if level is None else level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif compression == "zstd" and zstandard:
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compressobj()
+    else:
+        raise ValueError("Unsupported storage compression \"%s\"." % compression)
+
+
+def getCompression(path):
+    """Get the compression of a stored file from its suffix, or None if it isn't compressed."""
+    for compression, suffix in compressionSuffixes.items():
+        if path.endswith(suffix):
+            return compression
+    return None
+
+
+def stripCompressionSuffix(path):
+    """Get path without the suffix of its compression, if any."""
+    compression = getCompression(path)
+    return path[:-len(compressionSuffixes[compression])] if compression else path
@@ -1,18 +1,30 @@
 import datetime
 import json
+import os
+import socket
+from epgcompression import compressionSuffixes, zstandard
+from epglock import lockModes
 
 class EpgConfig:
-    def __init__(self, confPath):
-        """Load file from confPath, and parse as json."""
-        config = json.load(open(confPath))
+    def __init__(self, confPath, config=None):
+        """Load file from confPath, and parse as json.
+        The config of a feed is given as config: the settings of the file, overridden by those of the feed.
+        """
+        if config is None:
+            config = json.load(open(confPath))
 
-        for key in ["Username", "Password", "DataDir", "TrashDir", "LogFile", "LogFileMaxSize", "OldLogFiles", "StateMonitor", "EpgAgeLimit", "EpgAgeLimitWiggleRoom", "EpgMinSize", "EpgMaxSize"]:
+        required = ["Username", "Password", "DataDir", "TrashDir", "LogFile", "LogFileMaxSize", "OldLogFiles", "StateMonitor", "EpgAgeLimit", "EpgAgeLimitWiggleRoom", "EpgMinSize", "EpgMaxSize"]
+        # with a list of feeds, the URL can be given for each feed instead
+        if "Feeds" not in config:
+            required.append("EpgUrl")
+
+        for key in required:
             if not config.has_key(key):
                 raise Exception("Bad configuration: Missing \"%s\"." % key)
 
         self.username = config["Username"]
         self.password = config["Password"]
-        self.epgUrl = config["EpgUrl"]
+        self.epgUrl = config.get("EpgUrl")
         self.dataDir = config["DataDir"]
         self.trashDir = config["TrashDir"]
         self.logFile = config["LogFile"]
@@ -23,3 +35,82 @@ class EpgConfig:
         self.epgAgeLimitWiggleRoom = datetime.timedelta(hours=config["EpgAgeLimitWiggleRoom"])
         self.epgMinSize = config["EpgMinSize"]
         self.epgMaxSize = config["EpgMaxSize"]
+
+        # optional settings
+        self.fetchBackend = config.get("FetchBackend", "wget")
+        self.fetchConnectTimeout = config.get("FetchConnectTimeout", 30)
+        self.fetchReadTimeout = config.get("FetchReadTimeout", 300)
+        self.fetchRetries = config.get("FetchRetries", 2)
+        self.fetchRetryDelay = config.get("FetchRetryDelay", 10)
+        self.fetchCompression = config.get("FetchCompression", True)
+        self.manifestFile = config.get("ManifestFile")
+        self.manifestRebuildWorkers = config.get("ManifestRebuildWorkers", 8)
+        self.missingEpgReportLimit = config.get("MissingEpgReportLimit", 100)
+        self.daemonJitter = config.get("DaemonJitter", 300)
+        self.daemonSchedule = config.get("DaemonSchedule", "fixed")
+        self.adaptivePollInterval = config.get("AdaptivePollInterval", 300)
+        self.adaptiveMargin = config.get("AdaptiveMargin", 1800)
+        self.adaptiveHistoryDays = config.get("AdaptiveHistoryDays", 28)
+        self.adaptiveMinDays = config.get("AdaptiveMinDays", 3)
+        self.runLock = config.get("RunLock", "skip")
+        self.runLockTimeout = config.get("RunLockTimeout", 600)
+        self.runLockStaleAfter = config.get("RunLockStaleAfter", 3600)
+        self.lease = config.get("Lease", False)
+        self.leaseHolder = config.get("LeaseHolder", socket.gethostname())
+        # a lease expires halfway to the next run; the holder may renew it until that run, give or take DaemonJitter
+        self.leaseDuration = config.get("LeaseDuration", self.epgAgeLimit.total_seconds() / 2)
+        self.leaseRenewGrace = config.get("LeaseRenewGrace", max(self.epgAgeLimit.total_seconds() - self.leaseDuration, 0) + self.daemonJitter)
+        self.leaseGrace = config.get("LeaseGrace", 60)
+        self.metricsDir = config.get("MetricsDir")
+        self.historyFile = config.get("HistoryFile")
+        self.storageCompression = config.get("StorageCompression")
+        self.storageCompressionLevel = config.get("StorageCompressionLevel")
+        self.storageDeltas = config.get("StorageDeltas", False)
+        self.deltaChainLength = config.get("DeltaChainLength", 10)
+        self.stateMonitorBackground = config.get("StateMonitorBackground", False)
+        self.stateMonitorConnectTimeout = config.get("StateMonitorConnectTimeout", 10)
+        self.stateMonitorReadTimeout = config.get("StateMonitorReadTimeout", 30)
+        self.stateMonitorFailureLimit = config.get("StateMonitorFailureLimit", 3)
+        self.stateMonitorBreakerCooldown = config.get("StateMonitorBreakerCooldown", 600)
+        self.stateMonitorBreakerFile = config.get("StateMonitorBreakerFile", os.path.join(self.dataDir, ".statemonitor-breaker.json"))
+        self.stateMonitorSpoolFile = config.get("StateMonitorSpoolFile", os.path.join(self.dataDir, ".statemonitor-spool.jsonl"))
+        self.stateMonitorSpoolAll = config.get("StateMonitorSpoolAll", False)
+        self.stateMonitorSpoolBackoff = config.get("StateMonitorSpoolBackoff", 60)
+        self.stateMonitorSpoolMaxBackoff = config.get("StateMonitorSpoolMaxBackoff", 3600)
+
+        if self.fetchBackend not in ["wget", "http"]:
+            raise Exception("Bad configuration: Unknown FetchBackend \"%s\"." % self.fetchBackend)
+        if self.runLock not in lockModes:
+            raise Exception("Bad configuration: Unknown RunLock \"%s\"." % self.runLock)
+        if self.storageCompression is not None and self.storageCompression not in compressionSuffixes:
+            raise Exception("Bad configuration: Unknown StorageCompression \"%s\"." % self.storageCompression)
+        if self.storageCompression == "zstd" and not zstandard:
+            raise Exception("Bad configuration: StorageCompression \"zstd\" needs the python module zstandard.")
+        if self.daemonSchedule not in ["fixed", "adaptive"]:
+            raise Exception("Bad configuration: Unknown DaemonSchedule \"%s\"." % self.daemonSchedule)
+        # each host's manifest only knows the files that host saved, not those saved by the other while it held the lease
+        if self.lease and self.manifestFile:
+            raise Exception("Bad configuration: \"ManifestFile\" can't be used with \"Lease\".")
+
+        # several feeds can be downloaded by one process; without a list of feeds, the file describes the only one
+        self.feedName = config.get("Name")
+        self.feedWorkers = config.get("FeedWorkers", 4)
+        self.feeds = [self]
+
+        if "Feeds" in config:
+            self.feeds = []
+            for feed in config["Feeds"]:
+                # all feeds share one connection to the state monitor, and its circuit breaker and spool
+                for key in feed:
+                    if key.startswith("StateMonitor") and feed[key] != config.get(key):
+                        raise Exception("Bad configuration: \"%s\" can't be set for a single feed, all feeds report to the same state monitor." % key)
+                feedConfig = dict((key, value) for key, value in config.items() if key != "Feeds")
+                feedConfig.update(feed)
+                self.feeds.append(EpgConfig(confPath, feedConfig))
+
+            for key, values in [("Name", [f.feedName for f in self.feeds]),
+                                ("DataDir", [f.dataDir for f in self.feeds]),
+                                ("TrashDir", [f.trashDir for f in self.feeds]),
+                                ("ManifestFile", [f.manifestFile for f in self.feeds if f.manifestFile])]:
+                if None in values or len(set(values)) != len(values):
+                    raise Exception("Bad configuration: Every feed needs its own \"%s\"." % key)
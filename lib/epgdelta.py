@@ -0,0 +1,84 @@
+import re
+
+# the filename of an EPG file stored as a delta gets this suffix, before that of its compression
+deltaSuffix = ".delta"
+
+deltaHeader = "yousee-epg-delta 1\n"
+
+# consecutive tokens that must match before data is copied from the base
+anchorLength = 8
+
+def tokenize(data):
+    """Split XML data after every ">", so tags, and the text between them, are the units that are matched."""
+    return re.findall(r"[^>]*>|[^>]+$", data)
+
+
+def createDelta(base, target):
+    """Create a delta that turns base into target.
+    A delta is a header followed by operations: "C offset length" copies
+    length bytes of base from offset, and "I length" inserts the length
+    bytes that follow it. Runs of at least anchorLength tokens found in base
+    are copied, and extended for as long as the following tokens match.
+    """
+    baseTokens = tokenize(base)
+    targetTokens = tokenize(target)
+
+    offsets = [0]
+    for token in baseTokens:
+        offsets.append(offsets[-1] + len(token))
+
+    anchors = {}
+    for i in xrange(len(baseTokens) - anchorLength + 1):
+        anchors.setdefault(tuple(baseTokens[i:i + anchorLength]), i)
+
+    parts = [deltaHeader]
+    inserted = []
+
+    def flushInserted():
+        if inserted:
+            data = "".join(inserted)
+            parts.append("I %i\n%s" % (len(data), data))
+            del inserted[:]
+
+    j = 0
+    while j < len(targetTokens):
+        i = anchors.get(tuple(targetTokens[j:j + anchorLength])) if j + anchorLength <= len(targetTokens) else None
+        if i is None:
+            inserted.append(targetTokens[j])
+            j += 1
+            continue
+
+        length = anchorLength
+        while i + length < len(baseTokens) and j + length < len(targetTokens) and baseTokens[i + length] == targetTokens[j + length]:
+            length += 1
+        flushInserted()
+        parts.append("C %i %i\n" % (offsets[i], offsets[i + length] - offsets[i]))
+        j += length
+
+    flushInserted()
+    return "".join(parts)
+
+
+def applyDelta(base, delta):
+    """Turn base into the target the delta was created for."""
+    if not delta.startswith(deltaHeader):
+        raise ValueError("Not an EPG delta.")
+
+    parts = []
+    position = len(deltaHeader)
+    while position < len(delta):
+        end = delta.index("\n", position)
+        operation = delta[position:end].split(" ")
+        position = end + 1
+
+        if operation[0] == "C":
+            offset, length = int(operation[1]), int(operation[2])
+            parts.append(base[offset:offset + length])
+        elif operation[0] == "I":
+            length = int(operation[1])
+            parts.append(delta[position:position + length])
+            position += length
+        else:
+            raise ValueError("Unknown operation \"%s\" in EPG delta." % operation[0])
+
+    return "".join(parts)
@@ -0,0 +1,333 @@
+import base64
+import logging
+import socket
+import time
+from httplib import HTTPConnection, HTTPSConnection, HTTPException
+from urlparse import urlparse, urljoin
+from epgcompression import DecompressionError, createDecompressor, supportedEncodings
+from epgstream import chunkSize, EpgStreamAborted
+
+# results of a fetch
+fetchFailed = "Failed"
+fetchOk = "Ok"
+fetchNotModified = "NotModified"
+fetchAborted = "Aborted"
+
+class FetchInterrupted(Exception):
+    """Raised when a download stops before all data has been received."""
+    pass
+
+
+class WgetOutput():
+    """Pass the output of wget on to the sink, and kill wget if the sink stops the download."""
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.process = None
+        self.aborted = None
+
+
+    def setProcess(self, process):
+        self.process = process
+        if self.aborted:
+            self.process.kill()
+
+
+    def write(self, chunk):
+        if self.aborted:
+            return
+
+        try:
+            self.sink.write(chunk)
+        except EpgStreamAborted as e:
+            self.aborted = e
+            if self.process:
+                self.process.kill()
+
+
+    def flush(self):
+        self.sink.flush()
+
+
+class WgetFetcher():
+    """Fetch EPG data by running wget in a subprocess."""
+    supportsResume = False
+
+    def __init__(self, config):
+        self.config = config
+
+
+    def fetch(self, sink, validators=None):
+        """Stream the EPG data into sink.
+        sh only keeps the last chunk of output in its internal buffer, and
+        _iter="err" moves its pipe queue, which is never emptied, from stdout to
+        the almost silent stderr (wget logs to the log file), so memory usage
+        doesn't grow with the size of the EPG data.
+        wget always downloads everything; validators are ignored.
+        """
+        # sh takes a while to import, and the http backend doesn't need it
+        import sh
+        output = WgetOutput(sink)
+
+        try:
+            wgetProc = sh.wget(self.config.epgUrl, "-nv", a=self.config.logFile, O="-", user=self.config.username, password=self.config.password,
+                               timeout=self.config.fetchReadTimeout, _out=output, _out_bufsize=chunkSize, _internal_bufsize=1, _tty_out=False,
+                               _iter="err", _bg=True)
+            output.setProcess(wgetProc.process)
+            wgetProc.wait()
+        except sh.ErrorReturnCode:
+            return fetchFailed
+
+        # sh doesn't raise an exception when wget is killed
+        if output.aborted:
+            logging.error("Stopped wget: %s" % output.aborted)
+            return fetchAborted
+        else:
+            return fetchOk
+
+
+    def close(self):
+        pass
+
+
+class HttpFetcher():
+    """Fetch EPG data in-process with httplib.
+    The connection is kept open between fetches, so a long-running process
+    only pays for the TCP handshake once.
+    """
+    maxRedirects = 5
+    supportsResume = True
+    # headers that are dropped when redirected to another scheme or host than that of EpgUrl
+    originHeaders = ["Authorization", "If-None-Match", "If-Modified-Since", "Range", "If-Range"]
+
+    def __init__(self, config):
+        self.config = config
+        self.connection = None
+        self.connectionKey = None
+
+
+    def _getConnection(self, scheme, netloc):
+        """Reuse the open connection if it points to the same server, otherwise open a new one."""
+        if self.connection and self.connectionKey == (scheme, netloc):
+            return self.connection, True
+
+        self.close()
+
+        if scheme == "https":
+            connection = HTTPSConnection(netloc, timeout=self.config.fetchConnectTimeout)
+        else:
+            connection = HTTPConnection(netloc, timeout=self.config.fetchConnectTimeout)
+
+        connection.connect()
+        connection.sock.settimeout(self.config.fetchReadTimeout)
+        self.connection = connection
+        self.connectionKey = (scheme, netloc)
+        return connection, False
+
+
+    def _getHeaders(self, validators):
+        credentials = base64.b64encode("%s:%s" % (self.config.username, self.config.password))
+        headers = {"Authorization": "Basic " + credentials}
+
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("lastModified"):
+            headers["If-Modified-Since"] = validators["lastModified"]
+
+        return headers
+
+
+    def _request(self, url, headers):
+        """Send a GET request for url, retrying once on a fresh connection if a reused one turned out to be stale."""
+        urlParts = urlparse(url)
+        path = urlParts.path or "/"
+        if urlParts.query:
+            path += "?" + urlParts.query
+
+        connection, reused = self._getConnection(urlParts.scheme, urlParts.netloc)
+
+        try:
+            connection.request("GET", path, headers=headers)
+            return connection.getresponse()
+        except (socket.error, HTTPException):
+            self.close()
+            if not reused:
+                raise
+
+        connection, reused = self._getConnection(urlParts.scheme, urlParts.netloc)
+        connection.request("GET", path, headers=headers)
+        return connection.getresponse()
+
+
+    def fetch(self, sink, validators=None):
+        """Stream the EPG data into sink.
+        If validators from an earlier download are given, the request is made
+        conditional, and nothing is downloaded if the server says the data is
+        unchanged.
+        If the sink already holds part of the data, only the rest is requested.
+        A download that is interrupted is retried, continuing where it stopped.
+        """
+        for attempt in range(self.config.fetchRetries + 1):
+            if attempt > 0:
+                logging.info("Retrying download in %s seconds (%i of %i)." % (self.config.fetchRetryDelay, attempt, self.config.fetchRetries))
+                time.sleep(self.config.fetchRetryDelay)
+
+            try:
+                return self._fetch(sink, validators or {})
+            except FetchInterrupted as e:
+                logging.error(str(e))
+                self.close()
+            except EpgStreamAborted as e:
+                # the rest of the response is never read, so the connection can't be reused
+                logging.error("Stopped download: %s" % e)
+                self.close()
+                return fetchAborted
+
+        return fetchFailed
+
+
+    def _getRangeHeaders(self, sink):
+        """Get the headers for requesting the rest of a partial download in sink.
+        If-Range makes the server send everything if the data has changed since.
+        """
+        if sink.getSize() == 0:
+            return {}
+
+        etag = sink.getValidators().get("etag")
+        lastModified = sink.getValidators().get("lastModified")
+        encoding = sink.getValidators().get("encoding", "identity")
+
+        # weak etags can't be used with If-Range, and the etag of a compressed
+        # response doesn't match the uncompressed data, which is what's resumed
+        if etag and not etag.startswith("W/") and encoding == "identity":
+            ifRange = etag
+        elif lastModified:
+            ifRange = lastModified
+        else:
+            sink.restart()
+            return {}
+
+        logging.info("Resuming download from byte %i." % sink.getSize())
+        # byte ranges refer to the data as sent, so the rest is asked for uncompressed
+        return {"Range": "bytes=%i-" % sink.getSize(), "If-Range": ifRange, "Accept-Encoding": "identity"}
+
+
+    def _getRedirectHeaders(self, url, headers):
+        """Get the headers to send to url, which EpgUrl may have redirected to.
+        The credentials, and the validators and range of the data from EpgUrl,
+        are only sent to the scheme and host of EpgUrl itself.
+        """
+        origin = urlparse(self.config.epgUrl)
+        target = urlparse(url)
+        if (target.scheme, target.netloc) == (origin.scheme, origin.netloc):
+            return headers
+
+        return dict((name, value) for name, value in headers.items() if name not in self.originHeaders)
+
+
+    def _fetch(self, sink, validators):
+        url = self.config.epgUrl
+        headers = self._getHeaders(validators)
+        if self.config.fetchCompression:
+            headers["Accept-Encoding"] = ", ".join(supportedEncodings())
+        headers.update(self._getRangeHeaders(sink))
+
+        try:
+            for i in range(self.maxRedirects + 1):
+                response = self._request(url, self._getRedirectHeaders(url, headers))
+
+                if response.status in (301, 302, 303, 307, 308) and response.getheader("Location"):
+                    response.read()
+                    url = urljoin(url, response.getheader("Location"))
+                    logging.info("Redirected to \"%s\"." % url)
+                    continue
+                break
+
+            if response.status == 304:
+                response.read()
+                logging.info("\"%s\" not modified." % url)
+                return fetchNotModified
+
+            if response.status == 416:
+                # the partial data doesn't fit what's on the server anymore
+                response.read()
+                sink.restart()
+                raise FetchInterrupted("Range not satisfiable for \"%s\", starting over." % url)
+
+            encoding = (response.getheader("Content-Encoding") or "identity").strip().lower()
+
+            if response.status == 206:
+                contentRange = response.getheader("Content-Range", "")
+                if not contentRange.startswith("bytes %i-" % sink.getSize()) or encoding != "identity":
+                    response.read()
+                    sink.restart()
+                    raise FetchInterrupted("Unexpected Content-Range \"%s\" from \"%s\", starting over." % (contentRange, url))
+            elif response.status == 200:
+                # the whole file is sent, either because nothing was requested or the data has changed
+                sink.restart()
+                sink.setValidators({"etag": response.getheader("ETag"), "lastModified": response.getheader("Last-Modified"), "encoding": encoding})
+            else:
+                logging.error("Failed to fetch \"%s\": %s %s" % (url, response.status, response.reason))
+                response.read()
+                return fetchFailed
+
+            if encoding == "identity":
+                decompressor = None
+            else:
+                try:
+                    decompressor = createDecompressor(encoding)
+                except ValueError as e:
+                    logging.error("Failed to fetch \"%s\": %s" % (url, e))
+                    response.read()
+                    return fetchFailed
+
+            # Content-Length is the size of the data as sent, the sink gets it decompressed
+            expected = response.getheader("Content-Length")
+            received = 0
+            while True:
+                chunk = response.read(chunkSize)
+                if not chunk:
+                    break
+                received += len(chunk)
+                if decompressor:
+                    chunk = decompressor.decompress(chunk)
+                sink.write(chunk)
+
+            if decompressor:
+                sink.write(decompressor.flush())
+
+            if response.will_close:
+                self.close()
+
+            if expected is not None and received != int(expected):
+                raise FetchInterrupted("Connection closed after %i of %s bytes from \"%s\"." % (received, expected, url))
+        except (socket.error, HTTPException) as e:
+            raise FetchInterrupted("Failed to fetch \"%s\": %s" % (url, e))
+        except DecompressionError as e:
+            # corrupt data won't get better by resuming it
+            logging.error("Failed to decompress data from \"%s\": %s" % (url, e))
+            sink.restart()
+            self.close()
+            return fetchFailed
+        else:
+            if decompressor:
+                logging.info("Fetched %i bytes from \"%s\", %i bytes uncompressed." % (received, url, sink.getSize()))
+            else:
+                logging.info("Fetched %i bytes from \"%s\"." % (received, url))
+            return fetchOk
+
+
+    def close(self):
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+            self.connectionKey = None
+
+
+fetchers = {
+    "wget": WgetFetcher,
+    "http": HttpFetcher,
+}
+
+def createFetcher(config):
+    return fetchers[config.fetchBackend](config)
@@ -1,31 +1,218 @@
 import datetime
+import errno
 import hashlib
 import logging
 import os
 import shutil
-import sh
+from epgcompression import compressionSuffixes, createCompressor, createDecompressor, getCompression, stripCompressionSuffix
+from epgdelta import applyDelta, createDelta, deltaSuffix
+from epgsidecar import EpgSidecar
+from epgstream import XmlStage, chunkSize
+from misc import atomicWrite
+
+class EpgFileInfo(object):
+    """Size, md5sum and modification time of an EPG file, calculated in a single pass over the data.
+    The inode, size and mtime tell whether the file has changed since. The size
+    and md5sum are those of the uncompressed data; storedSize is the size of a
+    compressed file on disk.
+    """
+    __slots__ = ("size", "md5sum", "mtime", "inode", "storedSize")
+
+    def __init__(self, size, md5sum, mtime=None, inode=None, storedSize=None):
+        self.size = size
+        self.md5sum = md5sum
+        self.mtime = mtime
+        self.inode = inode
+        self.storedSize = size if storedSize is None else storedSize
+
+
+    @classmethod
+    def fromChunks(cls, chunks, stat):
+        """Calculate the info of the uncompressed data in chunks, read from the file stat describes."""
+        m = hashlib.md5()
+        size = 0
+        for chunk in chunks:
+            m.update(chunk)
+            size += len(chunk)
+
+        return cls(size, m.hexdigest(), stat.st_mtime, stat.st_ino, stat.st_size)
+
+
+    @classmethod
+    def fromSidecar(cls, metadata, stat):
+        """Use the size and md5sum recorded in a sidecar, if they were recorded for the file as it is now."""
+        storedSize = metadata.get("storedSize", metadata.get("size"))
+        if metadata.get("md5sum") and storedSize == stat.st_size and metadata.get("mtime") == stat.st_mtime:
+            return cls(metadata["size"], metadata["md5sum"], stat.st_mtime, stat.st_ino, stat.st_size)
+        else:
+            return None
+
+
+    def isCurrent(self, stat):
+        """Check that the file is unchanged; the inode isn't known when the info comes from the manifest."""
+        return self.inode in (None, stat.st_ino) and (self.storedSize, self.mtime) == (stat.st_size, stat.st_mtime)
+
+
+    def toSidecar(self):
+        metadata = {"size": self.size, "md5sum": self.md5sum, "mtime": self.mtime}
+        if self.storedSize != self.size:
+            metadata["storedSize"] = self.storedSize
+        return metadata
+
+
+def readChunks(f, compression=None):
+    """Read the data of an open file a chunk at a time, decompressing it as it's read if it's stored compressed."""
+    decompressor = createDecompressor(compression) if compression else None
+    for chunk in iter(lambda: f.read(chunkSize), ""):
+        yield decompressor.decompress(chunk) if decompressor else chunk
+    if decompressor:
+        yield decompressor.flush()
+
 
 class EpgFile():
-    def __init__(self, config, path, data=None):
+    def __init__(self, config, path, stream=None, manifest=None, info=None):
         self.config = config
         self.path = path
-        self.data = data
+        self.stream = stream
+        self.sidecar = EpgSidecar(path)
+        self.manifest = manifest
+        self.info = info
 
 
-    def _getContent(self):
-        if self.data:
-            return self.data
+    def _getContentPath(self):
+        """Get the path of the file holding the data; the temporary file while streamed data is unpersisted."""
+        if self.stream:
+            return self.stream.getPath()
         else:
-            with open(self.path) as f:
-                return f.read()
+            return self.path
+
+
+    def _getInfo(self):
+        """Get the size and md5sum of the data.
+        They are looked up in the sidecar, and the file is only read if the
+        sidecar is missing or out of date, in which case the sidecar is updated.
+        """
+        stat = os.stat(self.path)
+        if self.info is None or not self.info.isCurrent(stat):
+            self.info = EpgFileInfo.fromSidecar(self.sidecar.load(), stat)
+            if self.info is None:
+                self.info = EpgFileInfo.fromChunks(self.readChunks(), stat)
+                self._saveInfo()
+
+        return self.info
+
+
+    def _saveInfo(self):
+        try:
+            self.sidecar.update(**self.info.toSidecar())
+        except (IOError, OSError) as e:
+            logging.warning("Failed to update sidecar \"%s\": %s" % (self.sidecar.getPath(), e))
 
 
     def getPath(self):
         return self.path
 
 
+    def getCompression(self):
+        """Get the compression the data is stored with, or None. Streamed data is only compressed once it's persisted."""
+        if self.stream:
+            return None
+        return getCompression(self.path)
+
+
+    def isDelta(self):
+        """Check whether the data is stored as a delta against the next newer version, see StorageDeltas."""
+        return not self.stream and stripCompressionSuffix(self.path).endswith(deltaSuffix)
+
+
+    def readChunks(self):
+        """Read the uncompressed data a chunk at a time."""
+        if self.isDelta():
+            data = self._readDelta()
+            for position in xrange(0, len(data), chunkSize):
+                yield data[position:position + chunkSize]
+            return
+
+        with open(self._getContentPath(), "rb") as f:
+            for chunk in readChunks(f, self.getCompression()):
+                yield chunk
+
+
+    def _readDelta(self):
+        """Rebuild the data of a delta from its base, which is a delta itself, unless it's a full snapshot."""
+        with open(self.path, "rb") as f:
+            delta = "".join(readChunks(f, self.getCompression()))
+        return applyDelta("".join(self._getDeltaBase().readChunks()), delta)
+
+
+    def _getDeltaBase(self):
+        relativePath = self.sidecar.load().get("deltaBase")
+        if not relativePath:
+            raise IOError(errno.ENOENT, "No base recorded for the delta", self.path)
+
+        path = os.path.join(self.config.dataDir, relativePath)
+        # the base may have been turned into a delta itself since
+        stem = stripCompressionSuffix(path) + deltaSuffix
+        for candidate in [path, stem] + [stem + suffix for suffix in compressionSuffixes.values()]:
+            if os.path.exists(candidate):
+                return EpgFile(self.config, candidate, manifest=self.manifest)
+        raise IOError(errno.ENOENT, "The base of the delta \"%s\" is missing" % self.path, path)
+
+
+    def getDeltaRun(self):
+        """Get the number of deltas just before this version, all of which have to be applied to rebuild the oldest of them."""
+        return self.sidecar.load().get("deltaRun", 0)
+
+
+    def setDeltaRun(self, run):
+        self.sidecar.update(deltaRun=run)
+
+
+    def storeAsDelta(self, base):
+        """Replace the data of this file with a delta against base, the next newer version, keeping its size, md5sum and mtime.
+        The delta is checked by rebuilding the data from it before the full data
+        is removed. Returns whether the data was replaced; it isn't, if the
+        delta wouldn't be smaller.
+        """
+        info = self._getInfo()
+        data = "".join(self.readChunks())
+        baseData = "".join(base.readChunks())
+        delta = createDelta(baseData, data)
+
+        if hashlib.md5(applyDelta(baseData, delta)).hexdigest() != info.md5sum:
+            raise ValueError("The delta of \"%s\" doesn't rebuild it." % self.path)
+        if len(delta) >= len(data):
+            return False
+
+        compression = self.config.storageCompression
+        deltaPath = stripCompressionSuffix(self.path) + deltaSuffix + (compressionSuffixes[compression] if compression else "")
+        stat = os.stat(self.path)
+        # keeps the mtime, which is when this version was found
+        self._writeFile(deltaPath, [delta], compression, stat.st_mtime)
+
+        deltaStat = os.stat(deltaPath)
+        metadata = self.sidecar.load()
+        metadata.update(EpgFileInfo(info.size, info.md5sum, deltaStat.st_mtime, deltaStat.st_ino, deltaStat.st_size).toSidecar())
+        metadata["deltaBase"] = os.path.relpath(base.getPath(), self.config.dataDir)
+        deltaSidecar = EpgSidecar(deltaPath)
+        deltaSidecar.save(metadata)
+
+        os.remove(self.path)
+        if os.path.exists(self.sidecar.getPath()):
+            os.remove(self.sidecar.getPath())
+        if self.manifest:
+            self.manifest.rename(self.path, deltaPath, deltaStat.st_size)
+
+        self.path = deltaPath
+        self.sidecar = deltaSidecar
+        self.info = None
+        return True
+
+
     def getSize(self):
-        return len(self._getContent())
+        if self.stream:
+            return self.stream.getSize()
+        return self._getInfo().size
 
 
     def getPrettySize(self):
@@ -34,14 +221,37 @@ class EpgFile():
 
     def getMd5sum(self):
         """Calculate the md5sum for the newest EPG file."""
-        m = hashlib.md5()
-        m.update(self._getContent())
-        return m.hexdigest()
+        if self.stream:
+            return self.stream.getMd5sum()
+        return self._getInfo().md5sum
+
+
+    def getValidators(self):
+        """Get the HTTP validators (ETag, Last-Modified) the server sent along with this EPG data."""
+        if self.stream:
+            return self.stream.getValidators()
+
+        metadata = self.sidecar.load()
+        return {"etag": metadata.get("etag"), "lastModified": metadata.get("lastModified")}
+
+
+    def getFencingToken(self):
+        """Get the token of the lease held by the host that saved this file, if any."""
+        return self.sidecar.load().get("fencingToken")
+
+
+    def setValidators(self, validators):
+        """Store newer validators for data that turned out to be unchanged."""
+        self.sidecar.update(**validators)
 
 
     def getTimeOfLastModification(self):
         """Get hours since last modification."""
-        modTime = os.path.getmtime(self.path)
+        if self.info and self.info.mtime is not None:
+            # already known from persisting, or from the manifest
+            modTime = self.info.mtime
+        else:
+            modTime = os.path.getmtime(self.path)
         return datetime.datetime.fromtimestamp(modTime)
 
 
@@ -51,13 +261,39 @@ class EpgFile():
 
 
     def isValidXml(self):
-        """Use xmllint to check the file for well-formed ness."""
-        try:
-            sh.xmllint("--noout", self.path)
-        except sh.ErrorReturnCode_1:
-            return False
+        """Check the file for well-formed ness.
+        Streamed data has been checked while downloading, persisted files are
+        checked with xmllint, or while they are decompressed or rebuilt, if
+        compressed or stored as a delta.
+        """
+        if self.stream:
+            return self.stream.isValidXml()
+
+        if self.getCompression() or self.isDelta():
+            xmlStage = XmlStage()
+            for chunk in self.readChunks():
+                xmlStage.feed(chunk)
+            valid = xmlStage.isValid()
         else:
-            return True
+            # sh takes a while to import, and is only needed here
+            import sh
+            try:
+                sh.xmllint("--noout", self._getContentPath())
+            except sh.ErrorReturnCode_1:
+                valid = False
+            else:
+                valid = True
+
+        if self.manifest:
+            self.manifest.setValid(self.path, valid)
+        return valid
+
+
+    def getXmlError(self):
+        """Get the error found while checking streamed data, if any."""
+        if self.stream:
+            return self.stream.getXmlError()
+        return None
 
 
     def fileSizeOK(self):
@@ -65,21 +301,70 @@ class EpgFile():
         return self.config.epgMinSize < self.getSize() < self.config.epgMaxSize
 
 
-    def persist(self):
+    def _writeFile(self, path, chunks, compression=None, mtime=None):
+        """Write chunks, compressed with compression if any, into a hidden temporary file, and rename it into place at path."""
+        directory, name = os.path.split(path)
+        tmpPath = os.path.join(directory, ".%s.tmp" % name)
+        compressor = createCompressor(compression, self.config.storageCompressionLevel) if compression else None
+
+        with atomicWrite(path, "wb", tmpPath=tmpPath, mtime=mtime) as f:
+            for chunk in chunks:
+                f.write(compressor.compress(chunk) if compressor else chunk)
+            if compressor:
+                f.write(compressor.flush())
+
+
+    def _setCompressedPath(self, compression):
+        """Add the suffix of compression to the path the data is persisted to."""
+        self.path += compressionSuffixes[compression]
+        self.sidecar = EpgSidecar(self.path)
+
+
+    def persist(self, fencingToken=None):
         """Decide whether or not to saved the downloaded EPG data.
          If the md5sum is the same as the previous, the new data is thrown away,
-         otherwise it is saved.
+         otherwise it is saved. The fencingToken of the lease, if any, is saved with it.
+         With StorageCompression, the data is compressed as it's written, and the path gets the suffix of the compression.
          """
+        compression = self.config.storageCompression
 
-        if self.data:
-            with open(self.path, "w") as f:
-                f.write(self.data)
-
+        if self.stream:
+            if compression:
+                self._setCompressedPath(compression)
+                with open(self.stream.getPath(), "rb") as f:
+                    self._writeFile(self.path, readChunks(f), compression)
+                # removes the uncompressed temporary file
+                self.stream.abort()
+            else:
+                self.stream.moveTo(self.path)
+            # the size and md5sum are known from the download, no need to read the file again
+            stat = os.stat(self.path)
+            self.info = EpgFileInfo(self.stream.getSize(), self.stream.getMd5sum(), stat.st_mtime, stat.st_ino, stat.st_size)
+            metadata = dict(self.stream.getValidators())
+            metadata.update(self.info.toSidecar())
+            if fencingToken is not None:
+                metadata["fencingToken"] = fencingToken
+            self.sidecar.save(metadata)
+            valid = self.stream.isValidXml()
+            self.stream = None
+            self._addToManifest(valid)
             return True
         else:
             return False
 
 
+    def _addToManifest(self, valid=None):
+        if self.manifest:
+            self.manifest.add(self.path, self.info.mtime, self.info.size, self.info.md5sum, self.info.storedSize, valid)
+
+
+    def discard(self):
+        """Remove the temporary file of streamed data that haven't been persisted."""
+        if self.stream:
+            self.stream.abort()
+            self.stream = None
+
+
     def moveToTrash(self):
         if not os.path.exists(self.config.trashDir):
             os.mkdir(self.config.trashDir)
@@ -94,5 +379,15 @@ class EpgFile():
             logging.error("Tried to trash a file, but \"%s\" already exists." % target)
             return False
 
-        shutil.move(self.path, target)
+        size, md5sum = self.getSize(), self.getMd5sum()
+
+        if self.stream:
+            self.stream.moveTo(target)
+            self.stream = None
+        else:
+            shutil.move(self.path, target)
+            self.sidecar = self.sidecar.moveTo(target)
+
+        if self.manifest:
+            self.manifest.trash(self.path, target, os.path.getmtime(target), size, md5sum, os.path.getsize(target))
         return target
@@ -0,0 +1,177 @@
+import datetime
+import math
+import sqlite3
+import time
+
+# the stages of a run that have their own column, in the order they run
+stageColumns = ["age_check", "download", "size_check", "md5_check", "xml_check", "write", "state_monitor"]
+
+# bounds in seconds of the buckets for the time between changes
+changeIntervals = [3600, 6 * 3600, 12 * 3600, 24 * 3600, 48 * 3600, 7 * 24 * 3600]
+
+class EpgHistory():
+    """One row per run of the downloader, kept in a sqlite database, for trends over time.
+    Every stage has its own column, so a query only reads what it needs,
+    and the aggregates are computed by sqlite where possible.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=60)
+
+        with self.connection:
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY,
+                feed TEXT,
+                started REAL,
+                wall REAL,
+                exit_code INTEGER,
+                errors INTEGER,
+                changed INTEGER,
+                bytes INTEGER,
+                md5sum TEXT,
+                %s)""" % ",\n                ".join("%s REAL" % column for column in stageColumns))
+            self.connection.execute("CREATE INDEX IF NOT EXISTS runs_started ON runs (feed, started)")
+
+
+    def close(self):
+        self.connection.close()
+
+
+    def add(self, feed, started, wall, exitCode, errors, changed, size, md5sum, stages):
+        """Add a run. changed is None if the run didn't get far enough to tell, stages maps columns to seconds."""
+        columns = ["feed", "started", "wall", "exit_code", "errors", "changed", "bytes", "md5sum"] + stageColumns
+        values = [feed, started, wall, exitCode, errors, None if changed is None else int(changed), size, md5sum] + \
+            [stages.get(column) for column in stageColumns]
+
+        with self.connection:
+            self.connection.execute("INSERT INTO runs (%s) VALUES (%s)" % (", ".join(columns), ", ".join("?" * len(columns))), values)
+
+
+    def getFeeds(self):
+        return [row[0] for row in self.connection.execute("SELECT DISTINCT feed FROM runs ORDER BY feed")]
+
+
+    def _where(self, feed, since):
+        # "IS" also matches the feed NULL, for a config without feeds
+        if since is None:
+            return "feed IS ?", [feed]
+        return "feed IS ? AND started >= ?", [feed, since]
+
+
+    def getCounts(self, feed, since=None):
+        """Get (runs, failed runs, changed runs, unchanged runs)."""
+        where, params = self._where(feed, since)
+        return self.connection.execute("""SELECT COUNT(*), COALESCE(SUM(exit_code != 0), 0),
+            COALESCE(SUM(changed = 1), 0), COALESCE(SUM(changed = 0), 0) FROM runs WHERE """ + where, params).fetchone()
+
+
+    def getPercentiles(self, feed, column, percentiles, since=None):
+        """Get the given percentiles of column, by nearest rank, or None if it has no values."""
+        if column not in ["wall", "bytes"] + stageColumns:
+            raise ValueError("Unknown column: %s" % column)
+        where, params = self._where(feed, since)
+        values = [row[0] for row in self.connection.execute("SELECT %s FROM runs WHERE %s AND %s IS NOT NULL ORDER BY %s" % (column, where, column, column), params)]
+        if not values:
+            return None
+        return [values[max(int(math.ceil(p / 100.0 * len(values))) - 1, 0)] for p in percentiles]
+
+
+    def getChangesByHour(self, feed, since=None):
+        """Get the number of runs that found changed EPG data, for each local hour of the day."""
+        where, params = self._where(feed, since)
+        counts = [0] * 24
+        for hour, count in self.connection.execute("""SELECT CAST(strftime('%H', started, 'unixepoch', 'localtime') AS INTEGER), COUNT(*)
+            FROM runs WHERE changed = 1 AND """ + where + " GROUP BY 1", params):
+            counts[hour] = count
+        return counts
+
+
+    def getChangeIntervals(self, feed, since=None):
+        """Get the number of times the EPG data changed within each of changeIntervals of the previous change, and beyond the last."""
+        where, params = self._where(feed, since)
+        counts = [0] * (len(changeIntervals) + 1)
+        previous = None
+        for (started,) in self.connection.execute("SELECT started FROM runs WHERE changed = 1 AND " + where + " ORDER BY started", params):
+            if previous is not None:
+                counts[len([bound for bound in changeIntervals if started - previous > bound])] += 1
+            previous = started
+        return counts
+
+
+    def getSizeTrend(self, feed, since, until, buckets=10):
+        """Split since..until into buckets, and get (bucket start, runs, min, average, max) of the sizes fetched in each."""
+        where, params = self._where(feed, since)
+        width = max((until - since) / float(buckets), 1)
+        return [(since + bucket * width, count, low, average, high) for bucket, count, low, average, high in self.connection.execute(
+            """SELECT CAST((started - ?) / ? AS INTEGER), COUNT(*), MIN(bytes), AVG(bytes), MAX(bytes)
+            FROM runs WHERE bytes IS NOT NULL AND """ + where + " GROUP BY 1 ORDER BY 1", [since, width] + params)]
+
+
+    def getFirstStarted(self, feed):
+        return self.connection.execute("SELECT MIN(started) FROM runs WHERE feed IS ?", [feed]).fetchone()[0]
+
+
+def parseWindow(window):
+    """Parse a window like "12h", "7d" or "4w" into seconds; "all" is None."""
+    if window == "all":
+        return None
+    units = {"h": 3600, "d": 24 * 3600, "w": 7 * 24 * 3600}
+    if len(window) < 2 or window[-1] not in units or not window[:-1].isdigit():
+        raise ValueError("Invalid window \"%s\", expected e.g. 12h, 7d, 4w or all" % window)
+    return int(window[:-1]) * units[window[-1]]
+
+
+def _bar(count, most, width=40):
+    return "#" * int(round(count * width / float(most))) if most else ""
+
+
+def describeInterval(seconds):
+    if seconds % (24 * 3600) == 0:
+        return "%id" % (seconds // (24 * 3600))
+    return "%ih" % (seconds // 3600)
+
+
+def formatStats(history, windows, now=None):
+    """Describe the runs in history, for every feed and window, as lines of text."""
+    now = now or time.time()
+    lines = []
+
+    for feed in history.getFeeds():
+        for window in windows:
+            seconds = parseWindow(window)
+            since = now - seconds if seconds else history.getFirstStarted(feed)
+            runs, failed, changed, unchanged = history.getCounts(feed, since)
+            lines.append("%s, %s: %i runs, %i failed, %i changed, %i unchanged" % (
+                "Feed \"%s\"" % feed if feed else "All runs", "last " + window if seconds else "all time", runs, failed, changed, unchanged))
+            if not runs:
+                lines.append("")
+                continue
+
+            lines.append("  seconds       p50      p90      p99      max")
+            for column in ["wall"] + stageColumns:
+                values = history.getPercentiles(feed, column, [50, 90, 99, 100], since)
+                if values:
+                    lines.append("  %-13s %s" % (column, " ".join("%8.3f" % value for value in values)))
+
+            byHour = history.getChangesByHour(feed, since)
+            if any(byHour):
+                lines.append("  changes by hour of day:")
+                for hour, count in enumerate(byHour):
+                    lines.append("    %02i %5i %s" % (hour, count, _bar(count, max(byHour))))
+
+                intervals = history.getChangeIntervals(feed, since)
+                labels = ["<= %s" % describeInterval(bound) for bound in changeIntervals] + ["> %s" % describeInterval(changeIntervals[-1])]
+                lines.append("  time since the previous change:")
+                for label, count in zip(labels, intervals):
+                    lines.append("    %-6s %5i %s" % (label, count, _bar(count, max(intervals))))
+
+            trend = history.getSizeTrend(feed, since, now)
+            if trend:
+                lines.append("  size in MB       runs      min  average      max")
+                for start, count, low, average, high in trend:
+                    lines.append("    %s %5i %8.2f %8.2f %8.2f" % (datetime.datetime.fromtimestamp(start).strftime("%Y-%m-%d %H:%M"), count,
+                                                                low / 1048576.0, average / 1048576.0, high / 1048576.0))
+            lines.append("")
+
+    return lines
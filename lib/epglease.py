@@ -0,0 +1,154 @@
+import errno
+import json
+import logging
+import os
+import time
+from misc import atomicWrite
+
+# name of the lease file in the data directory
+leaseFilename = ".yousee-epg.lease"
+
+class EpgLease():
+    """Lease on a data directory shared by several hosts, e.g. over NFS, where flock can't be trusted.
+    The lease file names the holder, a fencing token and an expiry time. The
+    holder renews the lease on every run. For renewGrace seconds after it has
+    expired, only the holder may still renew it, keeping its token; other
+    hosts stand by until then, plus grace seconds for clocks that don't agree.
+    A lease shorter than the time between runs, with a renewGrace that covers
+    the rest, lets a standby take over at its first run after the holder
+    missed one, while a holder that's on time never loses it. Taking the lease
+    increments the token. Two hosts taking it at the same time both try to
+    hard link a claim file for the new token, which only one of them can do,
+    since link() is atomic, even on NFS. Before saving anything, the holder
+    checks that the lease file still has its token, so a holder that was too
+    slow to renew can't overwrite the work of the one that took over.
+    """
+
+    def __init__(self, path, holder, duration, grace=60, renewGrace=0):
+        self.path = path
+        self.holder = holder
+        self.duration = duration
+        self.grace = grace
+        self.renewGrace = renewGrace
+        self.token = None
+        self.renewed = False
+        self.current = None
+
+
+    def _read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        except ValueError:
+            # the file is only ever replaced by rename, so this means someone meddled with it
+            logging.warning("Ignoring broken lease file \"%s\"." % self.path)
+            return None
+
+
+    def _write(self, token):
+        lease = {"holder": self.holder, "token": token, "expires": time.time() + self.duration}
+        # the temporary file is shared by all hosts, so it's named after this one
+        with atomicWrite(self.path, tmpPath="%s.%s.%i.tmp" % (self.path, self.holder, os.getpid()), sync=True) as f:
+            json.dump(lease, f)
+        self.current = lease
+
+
+    def _claim(self, token):
+        """Claim token by hard linking a file to its claim file. Returns whether this host got it."""
+        tmpPath = "%s.%s.%i.claim" % (self.path, self.holder, os.getpid())
+        with open(tmpPath, "w") as f:
+            f.write(self.holder)
+
+        try:
+            os.link(tmpPath, "%s.%i" % (self.path, token))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # on NFS, a link that succeeded may still report an error, if the reply was lost; the link count tells
+        claimed = os.stat(tmpPath).st_nlink == 2
+        os.remove(tmpPath)
+        return claimed
+
+
+    def _getClaims(self):
+        """Get the tokens of the claim files, and their paths."""
+        directory, name = os.path.split(self.path)
+        claims = []
+        for filename in os.listdir(directory):
+            suffix = filename[len(name) + 1:]
+            if filename.startswith(name + ".") and suffix.isdigit():
+                claims.append((int(suffix), os.path.join(directory, filename)))
+        return claims
+
+
+    def _removeOldClaims(self):
+        for token, path in self._getClaims():
+            if token < self.token:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+    def acquire(self):
+        """Take or renew the lease. Returns whether this host holds it; if not, it's the standby."""
+        now = time.time()
+        lease = self._read()
+        self.current = lease
+        self.token = None
+        self.renewed = False
+
+        if lease and lease["holder"] != self.holder and now < self.getDeadline(lease) + self.grace:
+            return False
+
+        if lease and lease["holder"] == self.holder and now < self.getDeadline(lease) - self.grace:
+            # nobody else can have taken it in the meantime, so the token stays the same
+            self._write(lease["token"])
+            self.token = lease["token"]
+            self.renewed = True
+            return True
+
+        # a host that died between claiming a token and writing the lease leaves a claim behind, which is skipped
+        token = max([lease["token"] if lease else 0] + [claim for claim, path in self._getClaims()]) + 1
+        if not self._claim(token):
+            self.current = self._read()
+            return False
+
+        self._write(token)
+        self.token = token
+        self._removeOldClaims()
+        if lease and lease["holder"] != self.holder:
+            logging.warning("Took over the lease \"%s\" from %s, who could have renewed it until %s." % (self.path, lease["holder"], self.describeDeadline(lease)))
+        return True
+
+
+    def isHeld(self):
+        """Check that this host still holds the lease, with the token it got."""
+        lease = self._read()
+        return self.token is not None and lease is not None and lease["token"] == self.token and \
+            lease["holder"] == self.holder and time.time() < self.getDeadline(lease)
+
+
+    def getDeadline(self, lease):
+        """Get the time until which the holder of lease may still renew it, after which other hosts may take it."""
+        return lease["expires"] + self.renewGrace
+
+
+    def getHolder(self):
+        return self.current["holder"] if self.current else None
+
+
+    def describe(self):
+        """Describe who holds the lease, for a standby."""
+        if not self.current:
+            return "another host is taking the lease"
+        return "%s holds the lease until %s" % (self.current["holder"], self.describeDeadline())
+
+
+    def describeDeadline(self, lease=None):
+        lease = lease or self.current
+        return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.getDeadline(lease)))
@@ -0,0 +1,115 @@
+import errno
+import fcntl
+import json
+import logging
+import os
+import signal
+import socket
+import time
+
+# name of the lock file in the data directory
+runLockFilename = ".yousee-epg.lock"
+
+# what to do when another run holds the lock
+lockSkip = "skip"
+lockWait = "wait"
+lockTakeover = "takeover"
+lockModes = [lockSkip, lockWait, lockTakeover]
+
+class RunLock():
+    """flock on a file in the data directory, held for the duration of a run.
+    The lock is released by the kernel when its holder dies, so it can only go
+    stale if the holder hangs. The holder writes its pid, host and start time
+    into the file, so a run that finds the lock taken can tell who has it,
+    and, in takeover mode, stop a holder that has had it for more than
+    staleAfter seconds.
+    """
+
+    def __init__(self, path, mode=lockSkip, timeout=600, staleAfter=3600):
+        self.path = path
+        self.mode = mode
+        self.timeout = timeout
+        self.staleAfter = staleAfter
+        self.file = None
+        self.waited = 0
+
+
+    def _tryLock(self):
+        try:
+            fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in [errno.EAGAIN, errno.EACCES]:
+                raise
+            return False
+
+        self.file.seek(0)
+        self.file.truncate()
+        json.dump({"pid": os.getpid(), "host": socket.gethostname(), "started": time.time()}, self.file)
+        self.file.flush()
+        return True
+
+
+    def getHolder(self):
+        """Get the pid, host and start time of the run holding the lock, as written by it, or {} if unknown."""
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+
+    def isStale(self, holder):
+        return "started" in holder and time.time() - holder["started"] > self.staleAfter
+
+
+    def _stop(self, holder):
+        """Ask a stale holder on this host to stop. Holders on other hosts can't be stopped from here."""
+        if holder.get("host") != socket.gethostname() or holder.get("pid") in [None, os.getpid()]:
+            logging.warning("Can't take over stale lock \"%s\" from %s." % (self.path, self.describe(holder)))
+            return
+
+        logging.warning("Taking over stale lock \"%s\", stopping %s." % (self.path, self.describe(holder)))
+        try:
+            os.kill(holder["pid"], signal.SIGTERM)
+        except OSError as e:
+            logging.warning("Failed to stop pid %s: %s" % (holder["pid"], e))
+
+
+    def describe(self, holder):
+        if not holder:
+            return "an unknown run"
+        started = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(holder.get("started", 0)))
+        return "pid %s on %s, running since %s" % (holder.get("pid"), holder.get("host"), started)
+
+
+    def acquire(self):
+        """Take the lock. Returns whether it was taken; if not, the run should be skipped."""
+        self.file = open(self.path, "a+")
+        start = time.time()
+
+        if self._tryLock():
+            return True
+
+        if self.mode == lockSkip:
+            self.file.close()
+            return False
+
+        if self.mode == lockTakeover:
+            holder = self.getHolder()
+            if self.isStale(holder):
+                self._stop(holder)
+
+        while time.time() - start < self.timeout:
+            time.sleep(1)
+            if self._tryLock():
+                self.waited = time.time() - start
+                return True
+
+        self.file.close()
+        return False
+
+
+    def release(self):
+        if self.file and not self.file.closed:
+            # the lock goes with the file
+            self.file.close()
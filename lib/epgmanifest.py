@@ -0,0 +1,153 @@
+import datetime
+import logging
+import os
+import sqlite3
+from epgfile import EpgFile
+
+class EpgManifest():
+    """Index of the EPG files in the data and trash directories, kept in a sqlite database.
+    Every change is made in its own transaction, so the manifest is always
+    consistent, even if the downloader dies halfway through a run.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # the connection is only used by one thread at a time, but not always the one that created it
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+
+        with self.connection:
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                year INTEGER,
+                timestamp REAL,
+                size INTEGER,
+                md5sum TEXT,
+                valid INTEGER,
+                trashed INTEGER NOT NULL DEFAULT 0,
+                stored_size INTEGER)""")
+            # manifests made before the stored size was recorded get it as NULL, which means the same as size
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(files)")]
+            if "stored_size" not in columns:
+                self.connection.execute("ALTER TABLE files ADD COLUMN stored_size INTEGER")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS files_newest ON files (trashed, year, path)")
+
+
+    def close(self):
+        self.connection.close()
+
+
+    @staticmethod
+    def _getYear(path, timestamp, trashed):
+        """Files in the data directory get the year of their directory, trashed files the year they were modified."""
+        if trashed:
+            return datetime.datetime.fromtimestamp(timestamp).year
+        else:
+            return int(os.path.basename(os.path.dirname(path)))
+
+
+    def add(self, path, timestamp, size, md5sum, storedSize, valid=None, trashed=False):
+        """size and md5sum are those of the data, storedSize that of the file, which may be compressed or a delta."""
+        year = self._getYear(path, timestamp, trashed)
+
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO files (path, year, timestamp, size, md5sum, valid, trashed, stored_size) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                    (path, year, timestamp, size, md5sum, valid, int(trashed), storedSize))
+
+
+    def setValid(self, path, valid):
+        with self.connection:
+            self.connection.execute("UPDATE files SET valid = ? WHERE path = ?", (int(valid), path))
+
+
+    def rename(self, path, newPath, storedSize):
+        """Record that the file at path is now stored at newPath, e.g. as a delta, with the same data."""
+        with self.connection:
+            self.connection.execute("UPDATE files SET path = ?, stored_size = ? WHERE path = ?", (newPath, storedSize, path))
+
+
+    def remove(self, path):
+        """Forget the file at path, e.g. because it has been removed from outside the downloader."""
+        with self.connection:
+            self.connection.execute("DELETE FROM files WHERE path = ?", (path,))
+
+
+    def trash(self, path, trashPath, timestamp, size, md5sum, storedSize):
+        """Record that the file at path has been moved to trashPath. The file doesn't have to be in the manifest already."""
+        with self.connection:
+            self.connection.execute("DELETE FROM files WHERE path = ?", (path,))
+            self.connection.execute("INSERT OR REPLACE INTO files (path, year, timestamp, size, md5sum, valid, trashed, stored_size) VALUES (?, ?, ?, ?, ?, 0, 1, ?)",
+                                    (trashPath, self._getYear(trashPath, timestamp, True), timestamp, size, md5sum, storedSize))
+
+
+    def getNewest(self):
+        """Get (path, timestamp, size, md5sum, storedSize) of the newest file in the data directory, or None if there are none.
+        Files are ordered like the directory listing used to order them: by year, then by filename.
+        """
+        return self.connection.execute("SELECT path, timestamp, size, md5sum, stored_size FROM files WHERE trashed = 0 ORDER BY year DESC, path DESC LIMIT 1").fetchone()
+
+
+    def getTimestamps(self, since):
+        """Get the modification times of the files in the data directory modified since since, oldest first."""
+        return [row[0] for row in self.connection.execute("SELECT timestamp FROM files WHERE trashed = 0 AND timestamp >= ? ORDER BY timestamp", (since,))]
+
+
+    def rebuild(self, dataDir, trashDir, getInfo, workers=8):
+        """Replace the manifest with the files found in dataDir and trashDir.
+        getInfo(path) must return (timestamp, size, md5sum, storedSize) for a file; it is
+        called from a pool of worker threads, since it may have to read the file.
+        The old manifest stays visible to readers until the rebuild is committed.
+        """
+        paths = []
+
+        if os.path.isdir(dataDir):
+            for year in sorted(os.listdir(dataDir)):
+                yearDir = os.path.join(dataDir, year)
+                if len(year) == 4 and year.isdigit() and os.path.isdir(yearDir):
+                    paths += [(os.path.join(yearDir, f), False) for f in os.listdir(yearDir) if not f.startswith(".")]
+
+        if os.path.isdir(trashDir):
+            paths += [(os.path.join(trashDir, f), True) for f in os.listdir(trashDir) if not f.startswith(".")]
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(workers)
+        try:
+            infos = pool.map(lambda (path, trashed): getInfo(path), paths)
+        finally:
+            pool.close()
+
+        with self.connection:
+            self.connection.execute("DELETE FROM files")
+            for (path, trashed), (timestamp, size, md5sum, storedSize) in zip(paths, infos):
+                year = self._getYear(path, timestamp, trashed)
+                self.connection.execute("INSERT INTO files (path, year, timestamp, size, md5sum, valid, trashed, stored_size) VALUES (?, ?, ?, ?, ?, NULL, ?, ?)",
+                                        (path, year, timestamp, size, md5sum, int(trashed), storedSize))
+
+        logging.info("Rebuilt manifest \"%s\" with %i files." % (self.path, len(paths)))
+        return len(paths)
+
+
+def rebuildManifest(config, manifest):
+    """Index all EPG files in the data and trash directories of config."""
+    def getInfo(path):
+        epg = EpgFile(config, path)
+        # the md5sum comes from the sidecar, the file is only read if that's missing
+        return os.path.getmtime(path), epg.getSize(), epg.getMd5sum(), os.path.getsize(path)
+
+    return manifest.rebuild(config.dataDir, config.trashDir, getInfo, config.manifestRebuildWorkers)
+
+
+def openManifest(config):
+    """Open the manifest configured in config, or return None if none is configured.
+    A new manifest is filled with the files already in the data directory.
+    """
+    if not config.manifestFile:
+        return None
+
+    isNew = not os.path.exists(config.manifestFile)
+    manifest = EpgManifest(config.manifestFile)
+
+    if isNew:
+        logging.info("Created manifest \"%s\", indexing existing files." % config.manifestFile)
+        rebuildManifest(config, manifest)
+
+    return manifest
@@ -0,0 +1,163 @@
+import json
+import os
+import resource
+import threading
+import time
+from misc import atomicWrite
+
+# python 2 doesn't know RUSAGE_THREAD; this is its value on Linux
+RUSAGE_THREAD = getattr(resource, "RUSAGE_THREAD", 1)
+
+def getCpuTime():
+    """CPU time of the calling thread, and of the child processes (wget, xmllint) that have finished."""
+    try:
+        usage = resource.getrusage(RUSAGE_THREAD)
+    except (ValueError, resource.error):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime + children.ru_utime + children.ru_stime
+
+
+def getMaxRss():
+    """Peak RSS in bytes of the process, or of the largest child process, whichever is larger."""
+    # ru_maxrss is in kilobytes on Linux
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+
+
+class RunMetrics():
+    """Wall time, CPU time, bytes and peak memory of each stage of a run, and the time spent reporting states.
+    A stage lasts from the "Started" state of a component to its "Completed"
+    or "Failed" state, so the StateInformerComponents mark the stages, and
+    time their own calls to the state monitor.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.stages = []
+        self.openStages = {}
+        self.calls = {}
+        self.outcome = {}
+
+
+    def startStage(self, name, entity=None):
+        with self.lock:
+            stage = {"stage": name, "result": None, "wall": None, "cpu": None, "bytes": 0, "maxRss": None}
+            self.stages.append(stage)
+            self.openStages[(entity, name)] = (stage, time.time(), getCpuTime())
+
+
+    def endStage(self, name, result, entity=None):
+        """End the stage name of entity. States of stages that never started, e.g. missing EPGs, end nothing."""
+        with self.lock:
+            if (entity, name) not in self.openStages:
+                return
+            stage, started, cpuStarted = self.openStages.pop((entity, name))
+            stage["result"] = result
+            stage["wall"] = time.time() - started
+            stage["cpu"] = getCpuTime() - cpuStarted
+            stage["maxRss"] = getMaxRss()
+
+
+    def addBytes(self, name, count):
+        """Count bytes processed by the latest stage called name."""
+        with self.lock:
+            for stage in reversed(self.stages):
+                if stage["stage"] == name:
+                    stage["bytes"] += count
+                    return
+
+
+    def addCall(self, component, state, seconds):
+        with self.lock:
+            count, total = self.calls.get((component, state), (0, 0.0))
+            self.calls[(component, state)] = (count + 1, total + seconds)
+
+
+    def setOutcome(self, **values):
+        """Record what the run found, e.g. whether the EPG data changed, for the run record."""
+        with self.lock:
+            self.outcome.update(values)
+
+
+    def getStageTime(self, name):
+        """Get the wall time of the stage name, or None if it didn't finish."""
+        with self.lock:
+            for stage in self.stages:
+                if stage["stage"] == name and stage["wall"] is not None:
+                    return stage["wall"]
+        return None
+
+
+    def getCallTime(self):
+        with self.lock:
+            return sum(count for count, total in self.calls.values()), sum(total for count, total in self.calls.values())
+
+
+    def getSummary(self):
+        """Describe the stages in one line, e.g. for the final state of the run."""
+        parts = []
+        with self.lock:
+            for stage in self.stages:
+                if stage["wall"] is None:
+                    continue
+                part = "%s %.3fs" % (stage["stage"], stage["wall"])
+                if stage["bytes"]:
+                    part += " (%.1fMB)" % (stage["bytes"] / 1024.0 / 1024.0)
+                parts.append(part)
+
+        calls, callTime = self.getCallTime()
+        parts.append("state monitor %.3fs (%i calls)" % (callTime, calls))
+        return "Run took %.3fs, peak RSS %.1fMB: %s" % (time.time() - self.started, getMaxRss() / 1024.0 / 1024.0, ", ".join(parts))
+
+
+    def getRecord(self, **extra):
+        """Get everything measured as a dict, for the json run record."""
+        with self.lock:
+            record = {
+                "started": self.started,
+                "wall": time.time() - self.started,
+                "maxRss": getMaxRss(),
+                "stages": [dict(stage) for stage in self.stages],
+                "stateMonitorCalls": [{"component": component, "state": state, "count": count, "seconds": total}
+                                      for (component, state), (count, total) in sorted(self.calls.items())],
+            }
+            record.update(self.outcome)
+        record.update(extra)
+        return record
+
+
+    def write(self, directory, name, feed=None, **extra):
+        """Write the metrics of the run to name.prom, for the Prometheus textfile collector, and name.json."""
+        record = self.getRecord(feed=feed, **extra)
+        with atomicWrite(os.path.join(directory, name + ".json")) as f:
+            json.dump(record, f, indent=4, sort_keys=True)
+        with atomicWrite(os.path.join(directory, name + ".prom")) as f:
+            f.write(_formatPrometheus(record))
+
+
+def _formatPrometheus(record):
+    feed = (record.get("feed") or "").replace("\\", "\\\\").replace("\"", "\\\"")
+    lines = []
+
+    def metric(name, help, samples):
+        lines.append("# HELP yousee_epg_%s %s" % (name, help))
+        lines.append("# TYPE yousee_epg_%s gauge" % name)
+        for labels, value in samples:
+            labels = ",".join(["feed=\"%s\"" % feed] + ["%s=\"%s\"" % label for label in labels])
+            lines.append("yousee_epg_%s{%s} %r" % (name, labels, float(value)))
+
+    stages = [stage for stage in record["stages"] if stage["wall"] is not None]
+    metric("run_timestamp_seconds", "Start of the last run.", [((), record["started"])])
+    metric("run_wall_seconds", "Wall time of the last run.", [((), record["wall"])])
+    metric("run_exit_code", "Exit code of the last run.", [((), record.get("exitCode", 0))])
+    metric("run_max_rss_bytes", "Peak RSS of the last run.", [((), record["maxRss"])])
+    metric("stage_wall_seconds", "Wall time of each stage of the last run.", [((("stage", s["stage"]),), s["wall"]) for s in stages])
+    metric("stage_cpu_seconds", "CPU time of each stage of the last run, including child processes.", [((("stage", s["stage"]),), s["cpu"]) for s in stages])
+    metric("stage_bytes", "Bytes processed by each stage of the last run.", [((("stage", s["stage"]),), s["bytes"]) for s in stages])
+    metric("stage_max_rss_bytes", "Peak RSS of the process at the end of each stage of the last run.", [((("stage", s["stage"]),), s["maxRss"]) for s in stages])
+    metric("state_monitor_calls", "Calls to the state monitor in the last run.",
+           [((("component", c["component"]), ("state", c["state"])), c["count"]) for c in record["stateMonitorCalls"]])
+    metric("state_monitor_seconds", "Time spent calling the state monitor in the last run.",
+           [((("component", c["component"]), ("state", c["state"])), c["seconds"]) for c in record["stateMonitorCalls"]])
+    return "\n".join(lines) + "\n"
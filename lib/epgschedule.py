@@ -0,0 +1,122 @@
+import os
+import time
+
+# length in seconds of the slots of the day that publish times are counted in
+slotLength = 900
+day = 24 * 3600
+
+def getPublishTimes(config, manifest, since):
+    """Get the modification times of the EPG files saved since since, from the manifest or the year directories.
+    A file is only saved when the EPG data has changed, so these are the times each change was found.
+    """
+    if manifest:
+        return manifest.getTimestamps(since)
+
+    times = []
+    if not os.path.isdir(config.dataDir):
+        return times
+    firstYear = time.localtime(since).tm_year
+    for year in os.listdir(config.dataDir):
+        yearDir = os.path.join(config.dataDir, year)
+        if len(year) != 4 or not year.isdigit() or int(year) < firstYear or not os.path.isdir(yearDir):
+            continue
+        for filename in os.listdir(yearDir):
+            if filename.startswith("."):
+                continue
+            try:
+                mtime = os.path.getmtime(os.path.join(yearDir, filename))
+            except OSError:
+                # trashed by a run in the meantime
+                continue
+            if mtime >= since:
+                times.append(mtime)
+    return sorted(times)
+
+
+class PublishSchedule():
+    """When to poll for new EPG data, learned from when changes were found before.
+    The day is split into slots of slotLength seconds; a slot in which changes
+    were found on at least minDays different days is a publish window, widened
+    by margin seconds on both sides. Inside a window, runs are pollInterval
+    apart, until the change of that window has been found; outside, the next run
+    is at the start of the next window. Runs are never more than the
+    interval apart, nor when too little is known to find any windows.
+    """
+
+    def __init__(self, times, interval, pollInterval, margin, minDays):
+        self.interval = interval
+        self.pollInterval = pollInterval
+        self.lastPublished = max(times) if times else None
+        self.windows = self._learn(times, margin, minDays)
+
+
+    def _learn(self, times, margin, minDays):
+        days = {}
+        for t in times:
+            local = time.localtime(t)
+            slot = (local.tm_hour * 3600 + local.tm_min * 60 + local.tm_sec) // slotLength
+            days.setdefault(slot, set()).add((local.tm_year, local.tm_yday))
+
+        # (start, end) in seconds after midnight, merged where they overlap; end may be past midnight
+        windows = []
+        for slot in sorted(slot for slot, found in days.items() if len(found) >= minDays):
+            start, end = slot * slotLength - margin, (slot + 1) * slotLength + margin
+            if windows and start <= windows[-1][1]:
+                windows[-1] = (windows[-1][0], max(windows[-1][1], end))
+            else:
+                windows.append((start, end))
+        return windows
+
+
+    def getWindows(self):
+        return self.windows
+
+
+    def _getMidnight(self, t):
+        local = time.localtime(t)
+        return time.mktime((local.tm_year, local.tm_mon, local.tm_mday, 0, 0, 0, 0, 0, -1))
+
+
+    def getWindowAt(self, t):
+        """Get (start, end) of the window t is in, as timestamps, or None if it's in none."""
+        midnight = self._getMidnight(t)
+        # windows reaching past midnight belong to the day before
+        for offset in [0, -day, day]:
+            for start, end in self.windows:
+                if midnight + offset + start <= t < midnight + offset + end:
+                    return midnight + offset + start, midnight + offset + end
+        return None
+
+
+    def getNextWindowStart(self, t):
+        """Get the start of the first window after t, as a timestamp, or None if there are no windows."""
+        midnight = self._getMidnight(t)
+        starts = [midnight + offset + start for offset in [-day, 0, day, 2 * day] for start, end in self.windows]
+        starts = [start for start in starts if start > t]
+        return min(starts) if starts else None
+
+
+    def getNextRun(self, started):
+        """Get the time of the run after the one started at started."""
+        latest = started + self.interval
+        window = self.getWindowAt(started)
+
+        if window and (self.lastPublished is None or self.lastPublished < window[0]):
+            # the change of this window hasn't been found yet
+            return min(started + self.pollInterval, latest)
+
+        nextStart = self.getNextWindowStart(window[1] if window else started)
+        if nextStart is None:
+            return latest
+        return min(nextStart, latest)
+
+
+    def describe(self):
+        if not self.windows:
+            return "no publish windows learned yet"
+        return "publish windows " + ", ".join("%s-%s" % (self._formatTime(start), self._formatTime(end)) for start, end in self.windows)
+
+
+    def _formatTime(self, seconds):
+        seconds %= day
+        return "%02i:%02i" % (seconds // 3600, seconds % 3600 // 60)
@@ -0,0 +1,47 @@
+import json
+import logging
+import os
+import shutil
+from misc import atomicWrite
+
+class EpgSidecar():
+    """Metadata about an EPG file, stored as json in a hidden file next to it."""
+
+    def __init__(self, epgPath):
+        directory, name = os.path.split(epgPath)
+        self.path = os.path.join(directory, ".%s.json" % name)
+
+
+    def getPath(self):
+        return self.path
+
+
+    def load(self):
+        """Return the stored metadata, or an empty dict if there is none."""
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except IOError:
+            return {}
+        except ValueError as e:
+            logging.warning("Ignoring broken sidecar \"%s\": %s" % (self.path, e))
+            return {}
+
+
+    def save(self, metadata):
+        with atomicWrite(self.path) as f:
+            json.dump(metadata, f)
+
+
+    def update(self, **metadata):
+        current = self.load()
+        current.update(metadata)
+        self.save(current)
+
+
+    def moveTo(self, epgPath):
+        """Move the sidecar along with its EPG file."""
+        target = EpgSidecar(epgPath)
+        if os.path.exists(self.path):
+            shutil.move(self.path, target.getPath())
+        return target
@@ -0,0 +1,274 @@
+import hashlib
+import os
+import shutil
+from xml.parsers import expat
+from epgsidecar import EpgSidecar
+
+# number of bytes read from the download at a time
+chunkSize = 64 * 1024
+
+# name of the file kept between runs, when a resumable download is interrupted
+partialFilename = ".yousee-epg.part"
+
+class EpgStreamAborted(Exception):
+    """Raised by a stage that has seen enough of the data to know it will be rejected."""
+    pass
+
+
+class SizeStage():
+    """Count the bytes, and stop the download as soon as there are too many."""
+
+    def __init__(self, minSize, maxSize):
+        self.minSize = minSize
+        self.maxSize = maxSize
+        self.reset()
+
+
+    def reset(self):
+        self.size = 0
+        self.exceeded = False
+
+
+    def feed(self, chunk):
+        self.size += len(chunk)
+        if self.maxSize is not None and self.size >= self.maxSize:
+            self.exceeded = True
+            raise EpgStreamAborted("EPG data reached the maximum size of %i bytes." % self.maxSize)
+
+
+    def finish(self):
+        pass
+
+
+    def isOK(self):
+        return (self.minSize is None or self.minSize < self.size) and not self.exceeded
+
+
+class DigestStage():
+    """Calculate the md5sum of the data."""
+
+    def __init__(self):
+        self.reset()
+
+
+    def reset(self):
+        self.md5 = hashlib.md5()
+
+
+    def feed(self, chunk):
+        self.md5.update(chunk)
+
+
+    def finish(self):
+        pass
+
+
+    def getMd5sum(self):
+        return self.md5.hexdigest()
+
+
+class XmlStage():
+    """Check the data for well-formedness with an incremental XML parser."""
+
+    def __init__(self):
+        self.reset()
+
+
+    def reset(self):
+        self.parser = expat.ParserCreate()
+        self.error = None
+        self.finished = False
+
+
+    def _parse(self, chunk, final=False):
+        # once an error is found, the rest of the data doesn't matter
+        if self.error is None:
+            try:
+                self.parser.Parse(chunk, final)
+            except expat.ExpatError as e:
+                self.error = e
+
+
+    def feed(self, chunk):
+        self._parse(chunk)
+
+
+    def finish(self):
+        if not self.finished:
+            self._parse("", True)
+            self.finished = True
+
+
+    def isValid(self):
+        self.finish()
+        return self.error is None
+
+
+    def getError(self):
+        return self.error
+
+
+class FileStage():
+    """Write the data to a temporary file."""
+
+    def __init__(self, path, append=False):
+        self.path = path
+        self.file = open(path, "ab" if append else "wb")
+
+
+    def reset(self):
+        self.file.seek(0)
+        self.file.truncate()
+
+
+    def feed(self, chunk):
+        self.file.write(chunk)
+
+
+    def finish(self):
+        self.close()
+
+
+    def flush(self):
+        self.file.flush()
+
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+class EpgStreamWriter():
+    """File-like sink for downloaded EPG data.
+    Every chunk passes through a pipeline of stages as it arrives: a size
+    check, which stops the download once EpgMaxSize is reached, an md5sum,
+    an incremental XML parser, and finally a temporary file. The data is read
+    exactly once and never held in memory, and the results of all the checks
+    are known as soon as the download is complete.
+
+    A resumable writer uses a fixed filename in partialDir, and continues
+    where an earlier, interrupted download left off, provided the validators
+    of that download are known, so the server can be asked whether the data is
+    still the same. partialDir shouldn't change between runs, unlike the year
+    directory the data ends up in.
+    """
+
+    def __init__(self, targetDir, filename, resume=False, minSize=None, maxSize=None, partialDir=None):
+        self.sizeStage = SizeStage(minSize, maxSize)
+        self.digestStage = DigestStage()
+        self.xmlStage = XmlStage()
+        # cache validators (ETag, Last-Modified) sent by the server
+        self.validators = {}
+
+        if resume:
+            self.path = os.path.join(partialDir or targetDir, partialFilename)
+            self.state = EpgSidecar(self.path)
+            self._openPartial()
+        else:
+            self.path = os.path.join(targetDir, ".%s.part" % filename)
+            self.state = None
+            self.fileStage = FileStage(self.path)
+
+        self.stages = [self.sizeStage, self.digestStage, self.xmlStage, self.fileStage]
+
+
+    def _openPartial(self):
+        validators = self.state.load()
+
+        if os.path.exists(self.path) and (validators.get("etag") or validators.get("lastModified")):
+            # the checks have to cover the whole file, so the partial data is read once
+            try:
+                with open(self.path, "rb") as f:
+                    for chunk in iter(lambda: f.read(chunkSize), ""):
+                        for stage in [self.sizeStage, self.digestStage, self.xmlStage]:
+                            stage.feed(chunk)
+            except EpgStreamAborted:
+                for stage in [self.sizeStage, self.digestStage, self.xmlStage]:
+                    stage.reset()
+                self.fileStage = FileStage(self.path)
+            else:
+                self.validators = validators
+                self.fileStage = FileStage(self.path, append=True)
+        else:
+            self.fileStage = FileStage(self.path)
+
+
+    def write(self, chunk):
+        for stage in self.stages:
+            stage.feed(chunk)
+
+
+    def flush(self):
+        self.fileStage.flush()
+
+
+    def close(self):
+        """Called when all data has been written."""
+        for stage in self.stages:
+            stage.finish()
+
+
+    def restart(self):
+        """Throw away the data written so far, e.g. because it belongs to an older version on the server."""
+        for stage in self.stages:
+            stage.reset()
+
+
+    def suspend(self):
+        """Close the file after a failed download. Resumable data is kept for the next attempt, anything else is removed."""
+        if self.state and self.sizeStage.size > 0 and self.validators and not self.sizeStage.exceeded:
+            self.fileStage.close()
+        else:
+            self.abort()
+
+
+    def abort(self):
+        """Close and remove the temporary file."""
+        self.fileStage.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        if self.state and os.path.exists(self.state.getPath()):
+            os.remove(self.state.getPath())
+
+
+    def moveTo(self, path):
+        """Move the finished download into place."""
+        self.fileStage.close()
+        shutil.move(self.path, path)
+        if self.state and os.path.exists(self.state.getPath()):
+            os.remove(self.state.getPath())
+
+
+    def getPath(self):
+        return self.path
+
+
+    def getSize(self):
+        return self.sizeStage.size
+
+
+    def isSizeOK(self):
+        return self.sizeStage.isOK()
+
+
+    def getMd5sum(self):
+        return self.digestStage.getMd5sum()
+
+
+    def isValidXml(self):
+        return self.xmlStage.isValid()
+
+
+    def getXmlError(self):
+        return self.xmlStage.getError()
+
+
+    def getValidators(self):
+        return self.validators
+
+
+    def setValidators(self, validators):
+        self.validators = validators
+        if self.state:
+            # saved right away, so the partial data can be resumed even if the process is killed
+            self.state.save(validators)
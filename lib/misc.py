@@ -1,10 +1,46 @@
+import calendar
 import os
 import shutil
-import sh
+import time
+from contextlib import contextmanager
 
 def createFilename(delta=0):
-    timestamp = sh.date("--iso-8601=seconds", date="%s seconds" % delta).stdout.strip()
-    return "yousee-epg_%s.xml" % timestamp
+    return "yousee-epg_%s.xml" % formatTimestamp(time.time() + delta)
+
+def formatTimestamp(t):
+    """Format the unix time t like `date --iso-8601=seconds` does: local time and its UTC offset."""
+    t = int(t)
+    localTime = time.localtime(t)
+    offset = (calendar.timegm(localTime) - t) // 60
+    sign = "+" if offset >= 0 else "-"
+    return "%s%s%02i:%02i" % (time.strftime("%Y-%m-%dT%H:%M:%S", localTime), sign, abs(offset) // 60, abs(offset) % 60)
+
+def createFilenames(deltas):
+    """Like createFilename, for a list of deltas, all relative to the same now."""
+    now = time.time()
+    return ["yousee-epg_%s.xml" % formatTimestamp(now + delta) for delta in deltas]
+
+@contextmanager
+def atomicWrite(path, mode="w", tmpPath=None, sync=False, mtime=None):
+    """Write the file at path through a temporary file, which is renamed into place once the block is done, so readers never see half a file.
+    Yields the temporary file, path + ".tmp" unless tmpPath is given. sync
+    makes sure the data is on disk before the rename, and mtime sets the
+    modification time. If the block fails, the temporary file is removed.
+    """
+    tmpPath = tmpPath or path + ".tmp"
+    try:
+        with open(tmpPath, mode) as f:
+            yield f
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        if mtime is not None:
+            os.utime(tmpPath, (time.time(), mtime))
+        os.rename(tmpPath, path)
+    except:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        raise
 
 def rotateLogs(config):
     """ Rotates the logs, when applicable.
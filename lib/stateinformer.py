@@ -1,8 +1,490 @@
+import errno
+import fcntl
+import json
 import logging
-from httplib import HTTPConnection
+import os
+from httplib import HTTPConnection, HTTPException
 import socket
+import threading
+import time
+from Queue import Queue
 from urllib import quote
 from urlparse import urlparse
+from misc import atomicWrite
+
+
+class CircuitBreaker():
+    """Keeps track of failures to reach the state monitor.
+    After failureLimit failures in a row the breaker opens, and no attempts
+    are made until cooldown seconds have passed; then a single attempt decides
+    whether to close it again. The state is saved in a file, so the next run
+    doesn't have to wait for the state monitor to time out before knowing
+    that it's down.
+    """
+
+    def __init__(self, path, failureLimit, cooldown):
+        self.path = path
+        self.failureLimit = failureLimit
+        self.cooldown = cooldown
+        self.failures = 0
+        self.openedAt = None
+        self._load()
+
+
+    def _load(self):
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    state = json.load(f)
+                self.failures = state["failures"]
+                self.openedAt = state["openedAt"]
+            except (IOError, ValueError, KeyError) as e:
+                logging.warning("Ignoring broken circuit breaker state \"%s\": %s" % (self.path, e))
+
+
+    def _save(self):
+        if not self.path:
+            return
+
+        try:
+            with atomicWrite(self.path) as f:
+                json.dump({"failures": self.failures, "openedAt": self.openedAt}, f)
+        except (IOError, OSError) as e:
+            logging.warning("Failed to save circuit breaker state \"%s\": %s" % (self.path, e))
+
+
+    def isOpen(self):
+        return self.openedAt is not None
+
+
+    def allow(self):
+        """Check whether an attempt should be made to reach the state monitor."""
+        if self.openedAt is None:
+            return True
+        # after the cooldown, let an attempt through to see if the state monitor is back
+        return time.time() - self.openedAt >= self.cooldown
+
+
+    def success(self):
+        if self.failures or self.openedAt is not None:
+            if self.openedAt is not None:
+                logging.info("State monitor is reachable again.")
+            self.failures = 0
+            self.openedAt = None
+            self._save()
+
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.failureLimit:
+            if self.openedAt is None:
+                logging.error("State monitor failed %i times in a row, not contacting it for %s seconds." % (self.failures, self.cooldown))
+            self.openedAt = time.time()
+        self._save()
+
+
+class StateSpool():
+    """Append-only file of states still to be sent to the state monitor, one json object per line.
+    The states are replayed in the order they were spooled. After a failed
+    replay, the next one waits backoff seconds, doubling with every failure
+    up to maxBackoff. The spool is shared by all runs, so it is only changed
+    under a lock, and only one process replays it at a time.
+    """
+
+    def __init__(self, path, backoff, maxBackoff, batchSize=100):
+        self.path = path
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.batchSize = batchSize
+        self.lockPath = path + ".lock"
+        self.replayLockPath = path + ".replay.lock"
+        self.statePath = path + ".state"
+
+
+    def _lock(self, path, blocking=True):
+        """Open and flock path. The lock is released when the returned file is closed."""
+        lockFile = open(path, "a")
+        try:
+            fcntl.flock(lockFile, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lockFile.close()
+            raise
+        return lockFile
+
+
+    def append(self, event):
+        line = json.dumps(event) + "\n"
+        with self._lock(self.lockPath):
+            with open(self.path, "a") as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+
+    def isEmpty(self):
+        return not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+
+
+    def count(self):
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path) as f:
+            return sum(1 for line in f)
+
+
+    def _read(self):
+        """Read the first batch of complete lines, as a list of (length, event). Broken lines give an event of None."""
+        events = []
+        if not os.path.exists(self.path):
+            return events
+
+        with open(self.path) as f:
+            for line in f:
+                # a line without a newline is still being written
+                if len(events) == self.batchSize or not line.endswith("\n"):
+                    break
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    logging.warning("Skipping broken line in state spool \"%s\": %r" % (self.path, line))
+                    event = None
+                events.append((len(line), event))
+        return events
+
+
+    def _remove(self, length):
+        """Remove the first length bytes from the spool, keeping states appended in the meantime."""
+        with self._lock(self.lockPath):
+            tmpPath = self.path + ".tmp"
+            with open(self.path, "rb") as f:
+                f.seek(length)
+                with open(tmpPath, "wb") as tmp:
+                    for chunk in iter(lambda: f.read(64 * 1024), ""):
+                        tmp.write(chunk)
+            if os.path.getsize(tmpPath) > 0:
+                os.rename(tmpPath, self.path)
+            else:
+                os.remove(tmpPath)
+                os.remove(self.path)
+
+
+    def _loadState(self):
+        try:
+            with open(self.statePath) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {"failures": 0, "nextAttempt": 0}
+
+
+    def isDue(self):
+        return time.time() >= self._loadState()["nextAttempt"]
+
+
+    def _failed(self):
+        state = self._loadState()
+        delay = min(self.backoff * 2 ** state["failures"], self.maxBackoff)
+        state = {"failures": state["failures"] + 1, "nextAttempt": time.time() + delay}
+        logging.warning("Failed to replay state spool \"%s\", trying again in %s seconds." % (self.path, delay))
+
+        try:
+            with atomicWrite(self.statePath) as f:
+                json.dump(state, f)
+        except (IOError, OSError) as e:
+            logging.warning("Failed to save state spool backoff \"%s\": %s" % (self.statePath, e))
+
+
+    def _succeeded(self):
+        if os.path.exists(self.statePath):
+            os.remove(self.statePath)
+
+
+    def replay(self, send, force=False):
+        """Send the spooled states in order with send(event), which returns whether the state was delivered.
+        Stops at the first failure. Unless force is set, nothing is sent until
+        the backoff after the last failure has passed. Returns the number of
+        states sent.
+        """
+        if not force and not self.isDue():
+            return 0
+
+        try:
+            replayLock = self._lock(self.replayLockPath, blocking=False)
+        except IOError as e:
+            if e.errno not in [errno.EAGAIN, errno.EACCES]:
+                raise
+            logging.info("State spool \"%s\" is being replayed by another process." % self.path)
+            return 0
+
+        sent = 0
+        with replayLock:
+            while True:
+                events = self._read()
+                if not events:
+                    self._succeeded()
+                    break
+
+                length = 0
+                for eventLength, event in events:
+                    if event is not None:
+                        if not send(event):
+                            break
+                        sent += 1
+                    length += eventLength
+                else:
+                    self._remove(length)
+                    continue
+
+                if length:
+                    self._remove(length)
+                self._failed()
+                break
+
+        if sent:
+            logging.info("Replayed %i states from state spool \"%s\"." % (sent, self.path))
+        return sent
+
+
+class StateReporter():
+    """Sends states to the state monitor over a single persistent connection.
+    The state monitor takes one state per request, so the requests are sent
+    back to back over the same connection. In background mode they are
+    queued and sent, in order, by a background thread, so reporting a state
+    never has to wait for the state monitor.
+
+    With a spool, states that can't be sent are written to the spool instead,
+    and so are all later states until the spool has been replayed, so the
+    state monitor gets them in order. Every state spooled behind others, and
+    closing the reporter, starts a replay, as far as the backoff of the spool
+    and the circuit breaker allow. With spoolAll, every state goes through
+    the spool, and is sent by a background thread.
+    """
+
+    def __init__(self, stateMonitorAddress, background=False, connectTimeout=None, readTimeout=None, breaker=None, spool=None, spoolAll=False):
+        self.stateMonitorAddress = stateMonitorAddress
+        self.address = urlparse(stateMonitorAddress).netloc
+        self.connectTimeout = connectTimeout
+        self.readTimeout = readTimeout
+        self.breaker = breaker
+        self.spool = spool
+        self.spoolAll = spoolAll and spool is not None
+        self.connection = None
+        self.lock = threading.Lock()
+        self.queue = None
+        self.replayLock = threading.Lock()
+        self.replayRequested = False
+        self.replayThread = None
+
+        if background:
+            self.queue = Queue()
+            self.thread = threading.Thread(target=self._sendQueued)
+            self.thread.daemon = True
+            self.thread.start()
+
+
+    def _send(self, path, data):
+        """Post data to path, returning the response status, reason and body.
+        A reused connection may have been closed by the server in the meantime,
+        so a request failing on it is retried once on a new connection.
+        """
+        # httplib only sends the headers and the body in one packet if the body is a str; otherwise
+        # the body waits for the server's delayed ACK of the headers, adding 40ms to every state
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+
+        for attempt in range(2):
+            reused = self.connection is not None
+
+            try:
+                if not reused:
+                    self.connection = HTTPConnection(self.address, timeout=self.connectTimeout)
+                    self.connection.connect()
+                    self.connection.sock.settimeout(self.readTimeout)
+                    self.connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+                self.connection.request("POST", path, data, {"Content-Type": "text/xml", "Accept": "application/json"})
+                response = self.connection.getresponse()
+                body = response.read()
+            except (socket.error, HTTPException):
+                if self.connection:
+                    self.connection.close()
+                    self.connection = None
+                if not reused:
+                    raise
+            else:
+                if response.will_close:
+                    self.connection.close()
+                    self.connection = None
+                return response.status, response.reason, body
+
+
+    def _deliver(self, entity, path, data, description, force=False):
+        """Send a state, returning the response status, reason and body, or None if the state monitor couldn't be reached.
+        Must be called with the lock held. force ignores an open circuit breaker.
+        """
+        if self.breaker and not self.breaker.allow() and not force:
+            return None
+
+        try:
+            logging.debug("Setting state for \"%s\" to \"%s\"" % (entity, description))
+            response = self._send(path, data)
+        except (socket.error, HTTPException) as e:
+            logging.error("Failed to communicate with state monitor at %s: %s" % (self.stateMonitorAddress, e))
+            if self.breaker:
+                self.breaker.failure()
+            return None
+
+        if self.breaker:
+            self.breaker.success()
+        return response
+
+
+    def send(self, entity, path, data, description):
+        """Send a state, returning whether it succeeded and the body of the response.
+        Spooled states are reported as successful.
+        """
+        with self.lock:
+            if self.spool and (self.spoolAll or not self.spool.isEmpty()):
+                # the state has to wait for the ones already in the spool
+                try:
+                    self._spool(entity, path, data, description)
+                except (IOError, OSError) as e:
+                    logging.error("Failed to spool state in \"%s\": %s" % (self.spool.path, e))
+                else:
+                    # whatever held up the spool may have cleared since, so it's replayed, backoff and circuit breaker permitting
+                    self.replay()
+                    return True, None
+
+            response = self._deliver(entity, path, data, description)
+            if response is None:
+                self.fallback(entity, path, data, description)
+                return False, None
+
+        status, reason, body = response
+        if status != 200:
+            logging.error("Failed to communicate with state monitor at %s: %s %s" % (self.stateMonitorAddress, status, reason))
+
+        return status == 200, body
+
+
+    def _spool(self, entity, path, data, description):
+        self.spool.append({"entity": entity, "path": path, "data": data, "description": description, "time": time.time()})
+
+
+    def fallback(self, entity, path, data, description):
+        """Handle a state that couldn't be sent to the state monitor, by spooling it if there's a spool."""
+        if self.spool:
+            try:
+                self._spool(entity, path, data, description)
+            except (IOError, OSError) as e:
+                logging.error("Failed to spool state in \"%s\": %s" % (self.spool.path, e))
+            else:
+                logging.warning("State \"%s\" for \"%s\" was spooled for the state monitor." % (description, entity))
+                return
+
+        logging.warning("State \"%s\" for \"%s\" was not sent to the state monitor." % (description, entity))
+
+
+    def post(self, entity, path, data, description):
+        """Send a state, or queue it in background mode. Queued states are reported as successful."""
+        if self.queue is not None:
+            self.queue.put((entity, path, data, description))
+            return True, None
+        else:
+            return self.send(entity, path, data, description)
+
+
+    def _sendQueued(self):
+        while True:
+            entity, path, data, description = self.queue.get()
+            try:
+                self.send(entity, path, data, description)
+            finally:
+                self.queue.task_done()
+
+
+    def _sendSpooled(self, event, force=False):
+        """Send a state from the spool, returning whether the spool is done with it."""
+        # json gives unicode, which httplib won't mix with non-ascii bytes
+        path = event["path"].encode("utf-8")
+        data = event["data"].encode("utf-8")
+
+        with self.lock:
+            response = self._deliver(event["entity"], path, data, event["description"], force)
+
+        if response is None:
+            return False
+
+        status, reason, body = response
+        if status != 200:
+            logging.error("State monitor rejected spooled state \"%s\" for \"%s\": %s %s" % (event["description"], event["entity"], status, reason))
+        # a state the state monitor doesn't accept now won't be accepted later either, unless it's the server's fault
+        return status < 500
+
+
+    def replay(self):
+        """Replay the spool in a background thread, unless it's waiting for the backoff after a failed replay."""
+        if not self.spool:
+            return
+
+        with self.replayLock:
+            self.replayRequested = True
+            if self.replayThread is None:
+                self.replayThread = threading.Thread(target=self._replay)
+                self.replayThread.daemon = True
+                self.replayThread.start()
+
+
+    def _replay(self):
+        while True:
+            with self.replayLock:
+                if not self.replayRequested:
+                    self.replayThread = None
+                    return
+                self.replayRequested = False
+
+            try:
+                self.spool.replay(self._sendSpooled)
+            except (IOError, OSError) as e:
+                logging.error("Failed to replay state spool \"%s\": %s" % (self.spool.path, e))
+
+
+    def flushSpool(self):
+        """Replay the spool right away, ignoring backoff and circuit breaker. Returns the number of states sent."""
+        if not self.spool:
+            return 0
+        return self.spool.replay(lambda event: self._sendSpooled(event, force=True), force=True)
+
+
+    def flush(self):
+        """Wait until all queued states have been sent, and the spool has been replayed as far as possible."""
+        if self.queue is not None:
+            self.queue.join()
+
+        with self.replayLock:
+            thread = self.replayThread
+        if thread:
+            thread.join()
+
+
+    def close(self):
+        # a last try to deliver the states spooled during the run, such as its final state
+        self.replay()
+        self.flush()
+        with self.lock:
+            if self.connection:
+                self.connection.close()
+                self.connection = None
+
+
+def createStateReporter(config):
+    """Create a StateReporter with the timeouts, circuit breaker and spool from config."""
+    breaker = CircuitBreaker(config.stateMonitorBreakerFile, config.stateMonitorFailureLimit, config.stateMonitorBreakerCooldown)
+    spool = None
+    if config.stateMonitorSpoolFile:
+        spool = StateSpool(config.stateMonitorSpoolFile, config.stateMonitorSpoolBackoff, config.stateMonitorSpoolMaxBackoff)
+    return StateReporter(config.stateMonitor, background=config.stateMonitorBackground,
+                         connectTimeout=config.stateMonitorConnectTimeout, readTimeout=config.stateMonitorReadTimeout,
+                         breaker=breaker, spool=spool, spoolAll=config.stateMonitorSpoolAll)
 
 
 class StateInformerComponent():
@@ -11,11 +493,14 @@ class StateInformerComponent():
     stateCompleted="Completed"
     stateDone="Done"
 
-    def __init__(self, stateMonitorAddress, entity, component):
+    def __init__(self, stateMonitorAddress, entity, component, reporter=None, metrics=None):
         self.stateMonitorAddress = stateMonitorAddress
         self.component = component
         self.entity = entity
         self.response = None
+        self.reporter = reporter or StateReporter(stateMonitorAddress)
+        # the states of the component mark the start and end of a stage in the metrics, see RunMetrics
+        self.metrics = metrics
 
 
     def getAddress(self):
@@ -37,26 +522,23 @@ class StateInformerComponent():
 
 
     def __postStatus(self, state, message=""):
+        # the stage lasts from after its "Started" state is posted until before its last state is, leaving out the state monitor
+        if self.metrics and state != self.stateStarted:
+            self.metrics.endStage(self.component, state, self.entity)
+        started = time.time()
+
         data = self.__createPayload(state, message)
         (address, path) = self.getAddress()
 
-        errorMsg = "Failed to communicate with state monitor at %s" % self.stateMonitorAddress
-
-        try:
-            connection = HTTPConnection(address)
-            logging.debug("Setting state for \"%s\" to \"%s\"" % (self.entity, state))
-            connection.request("POST", path, data, {"Content-Type": "text/xml", "Accept": "application/json"})
-            response = connection.getresponse()
-
-            self.response = response.read()
-        except socket.error as e:
-            logging.error("%s: %s" % (errorMsg, e))
-            return False
-        else:
-            if response.status != 200:
-                logging.error("%s: %s %s" % (errorMsg, response.status, response.reason))
+        ok, response = self.reporter.post(self.entity, path, data, state)
+        if response is not None:
+            self.response = response
 
-            return response.status == 200
+        if self.metrics:
+            self.metrics.addCall(self.component, state, time.time() - started)
+            if state == self.stateStarted:
+                self.metrics.startStage(self.component, self.entity)
+        return ok
 
 
     def getResponse(self):
@@ -76,10 +558,22 @@ class StateInformerComponent():
 
 
 class StateInformer():
-    def __init__(self, entity, stateMonitorAddress):
+    def __init__(self, entity, stateMonitorAddress, reporter=None, metrics=None):
         self.entity = entity
         self.stateMonitorAddress = stateMonitorAddress
+        self.reporter = reporter or StateReporter(stateMonitorAddress)
+        self.metrics = metrics
 
 
     def get(self, component):
-        return StateInformerComponent(self.stateMonitorAddress, self.entity, component)
+        return StateInformerComponent(self.stateMonitorAddress, self.entity, component, self.reporter, self.metrics)
+
+
+    def forEntity(self, entity):
+        """Get an informer for another entity, sharing this informer's connection to the state monitor."""
+        return StateInformer(entity, self.stateMonitorAddress, self.reporter, self.metrics)
+
+
+    def close(self):
+        """Wait for queued states to be sent, and close the connection to the state monitor."""
+        self.reporter.close()
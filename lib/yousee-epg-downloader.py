@@ -2,12 +2,19 @@
 
 from __future__ import division
 
-import os, sys, datetime, logging
-import sh
+import os, sys, datetime, logging, math, random, signal, sqlite3, threading, time
 from epgconfig import EpgConfig
-from epgfile import EpgFile
-from misc import rotateLogs, createFilename
-from stateinformer import StateInformer
+from epgfetch import createFetcher, fetchAborted, fetchFailed, fetchNotModified
+from epgfile import EpgFile, EpgFileInfo
+from epglease import EpgLease, leaseFilename
+from epghistory import EpgHistory, formatStats, parseWindow
+from epglock import RunLock, runLockFilename
+from epgmanifest import EpgManifest, openManifest, rebuildManifest
+from epgmetrics import RunMetrics
+from epgschedule import PublishSchedule, getPublishTimes
+from epgstream import EpgStreamWriter
+from misc import rotateLogs, createFilename, createFilenames
+from stateinformer import StateInformer, createStateReporter
 
 # defines
 epgComponent = "yousee-epg-fetcher"
@@ -17,37 +24,115 @@ epgSize = "yousee-epg-file-check"
 epgMd5 = "yousee-epg-md5-check"
 epgWriter = "yousee-epg-filewriter"
 epgXml = "yousee-epg-xml-validator"
+epgRunLock = "yousee-epg-run-lock"
+epgLease = "yousee-epg-lease"
+
+# the columns of the stages in the run history
+historyColumns = {epgAgeCheck: "age_check", epgDownload: "download", epgSize: "size_check", epgMd5: "md5_check",
+                  epgXml: "xml_check", epgWriter: "write"}
 
 class YouseeEpgDownloader():
-    def __init__(self, config, informer, filename):
+    def __init__(self, config, informer, filename, lease=None):
         self.config = config
         self.filename = filename
         self.informer = informer
+        self.lease = lease
+        self.fetcher = createFetcher(config)
+        self.manifest = openManifest(config)
+        self.missingEpgReport = None
+        self.newestEpg = None
+
+
+    def reset(self, informer, filename, lease=None):
+        """Prepare for another run, keeping the connection to the server and what's known about the newest EPG file.
+        The newest EPG file is forgotten when the lease has changed hands, since another host may have saved a newer one.
+        """
+        self.informer = informer
+        self.filename = filename
+        self.missingEpgReport = None
+        if lease and not lease.renewed:
+            self.newestEpg = None
+        self.lease = lease
+
+
+    def holdsLease(self):
+        """Check that this host still holds the lease, and that no later holder of it has saved a file."""
+        if not self.lease.isHeld():
+            return False
+        newestEpg = self.getNewestEpgFile()
+        return not newestEpg or newestEpg.getFencingToken() <= self.lease.token
 
 
     def getInformerComponent(self):
-        return informer.get(epgComponent)
+        return self.informer.get(epgComponent)
 
 
-    def fetchEpg(self, filename):
-        """Use wget to fetch EPG data into memory"""
-        try:
-            wgetProc = sh.wget(self.config.epgUrl, "-nv", a=self.config.logFile, O="-", user=self.config.username, password=self.config.password)
-        except sh.ErrorReturnCode:
-            return None
-        else:
-            year = str(datetime.datetime.today().year)
-            targetDir = os.path.join(self.config.dataDir, year)
+    def addBytes(self, stage, count):
+        """Count bytes processed by a stage, in the metrics of the run."""
+        if self.informer.metrics:
+            self.informer.metrics.addBytes(stage, count)
+
+
+    def setOutcome(self, **values):
+        """Record what the run found, in the metrics of the run."""
+        if self.informer.metrics:
+            self.informer.metrics.setOutcome(**values)
+
+
+    def fetchEpg(self, filename, newestEpg=None):
+        """Stream EPG data into a temporary file in the data directory, using the configured fetch backend.
+        Size, md5sum and XML checks are made on the data as it passes through,
+        and the download is stopped if the data grows too large.
+        The validators stored with newestEpg are used to make the request conditional.
+        Returns a tuple of the fetch result and the new EpgFile, if any.
+        """
+        year = str(datetime.datetime.today().year)
+        targetDir = os.path.join(self.config.dataDir, year)
+
+        if not os.path.exists(targetDir):
+            os.mkdir(targetDir)
 
-            if not os.path.exists(targetDir):
-                os.mkdir(targetDir)
+        # partial data to resume is kept in the data directory itself, so it's found again after the turn of the year
+        stream = EpgStreamWriter(targetDir, filename, resume=self.fetcher.supportsResume,
+                                 minSize=self.config.epgMinSize, maxSize=self.config.epgMaxSize, partialDir=self.config.dataDir)
 
+        validators = newestEpg.getValidators() if newestEpg else None
+        result = self.fetcher.fetch(stream, validators)
+
+        if result == fetchFailed:
+            # keep partial data for the next run, if the fetcher can resume it
+            stream.suspend()
+            return result, None
+        elif result == fetchNotModified:
+            stream.abort()
+            return result, None
+        else:
+            stream.close()
             filepath = os.path.join(targetDir, filename)
-            return EpgFile(self.config, filepath, data=wgetProc.stdout)
+            return result, EpgFile(self.config, filepath, stream=stream, manifest=self.manifest)
 
 
     def getNewestEpgFile(self):
-        """Get the newest EPG file stored in the data directory."""
+        """Get the newest EPG file stored in the data directory.
+        It's remembered, so it's only looked up again if it has disappeared.
+        """
+        if self.newestEpg is None or not os.path.exists(self.newestEpg.getPath()):
+            self.newestEpg = self._findNewestEpgFile()
+        return self.newestEpg
+
+
+    def _findNewestEpgFile(self):
+        if self.manifest:
+            newest = self.manifest.getNewest()
+            # files removed behind the manifest's back are forgotten, so the newest file that's still there is found
+            while newest and not os.path.exists(newest[0]):
+                logging.warning("EPG file \"%s\" in manifest \"%s\" doesn't exist, removing it from the manifest." % (newest[0], self.manifest.path))
+                self.manifest.remove(newest[0])
+                newest = self.manifest.getNewest()
+            if newest:
+                path, timestamp, size, md5sum, storedSize = newest
+                return EpgFile(self.config, path, manifest=self.manifest, info=EpgFileInfo(size, md5sum, timestamp, storedSize=storedSize))
+            return None
 
         # get the files and dirs in self.config.dataDir
         dirs = sorted(os.listdir(self.config.dataDir))
@@ -65,9 +150,10 @@ class YouseeEpgDownloader():
         dirs.reverse()
 
         for thisDir in dirs:
-            files = sorted(os.listdir(thisDir))
+            # hidden files are temporary files of downloads in progress
+            files = sorted(filter(lambda f: not f.startswith("."), os.listdir(thisDir)))
             if len(files) != 0:
-                return EpgFile(self.config, os.path.join(thisDir, files[-1]))
+                return EpgFile(self.config, os.path.join(thisDir, files[-1]), manifest=self.manifest)
 
         return None
 
@@ -89,28 +175,72 @@ class YouseeEpgDownloader():
                 save = True
 
         if save:
-            return epg.persist()
+            persisted = epg.persist(self.lease.token if self.lease else None)
+            if persisted:
+                self.newestEpg = epg
+                if oldEpg and self.config.storageDeltas:
+                    self.storeDelta(oldEpg, epg)
+            return persisted
         else:
+            if oldEpg and epg.getValidators():
+                # keep the validators next to the newest file up to date
+                oldEpg.setValidators(epg.getValidators())
             return False
 
 
+    def storeDelta(self, oldEpg, newEpg):
+        """Replace oldEpg with a delta against newEpg, which is the newest version now, so it's always stored in full.
+        Versions are rebuilt from the next newer one, so oldEpg is kept in full
+        instead if the deltas before it would otherwise make a chain longer than
+        DeltaChainLength. Failing to store a delta doesn't fail the run.
+        """
+        run = oldEpg.getDeltaRun()
+        if run >= self.config.deltaChainLength:
+            newEpg.setDeltaRun(0)
+            return
+
+        try:
+            if oldEpg.storeAsDelta(newEpg):
+                logging.info("Stored \"%s\" as a delta." % oldEpg.getPath())
+                newEpg.setDeltaRun(run + 1)
+            else:
+                newEpg.setDeltaRun(0)
+        except (IOError, OSError, ValueError) as e:
+            logging.warning("Failed to store \"%s\" as a delta, kept it in full: %s" % (oldEpg.getPath(), e))
+            newEpg.setDeltaRun(0)
+
+
     def reportMissingEpgFiles(self, newestEpg):
-        def missingEpgs():
-            """Yield a list of seconds relative to now that corresponds to a time where epg should have been downloaded. Very roughly."""
-            now = datetime.datetime.today()
-            t = self.config.epgAgeLimit
-
-            while now - t > newestEpg.getTimeOfLastModification():
-                yield (t.microseconds + (t.seconds + t.days * 24 * 3600) * 10**6) / 10**6
-                t += self.config.epgAgeLimit
-
-        for epg in missingEpgs():
-            filename_ = createFilename(-epg)
-            informer_ = StateInformer(filename_, self.config.stateMonitor)
-            epgComponent_ = informer_.get(epgComponent)
-            epgComponent_.failed()
-            msg = "Missing EPG: " + filename_
-            logging.error(msg)
+        """Report a failed download for every EPG that should have been downloaded since newestEpg. Very roughly.
+        The newest MissingEpgReportLimit of them are reported by a background
+        thread, the rest are only counted in the log.
+        """
+        step = self.config.epgAgeLimit.total_seconds()
+        gap = (datetime.datetime.today() - newestEpg.getTimeOfLastModification()).total_seconds()
+        # an EPG is missing every step seconds back from now, as long as that's after newestEpg
+        missing = max(int(math.ceil(gap / step)) - 1, 0)
+        reported = min(missing, self.config.missingEpgReportLimit)
+        filenames = createFilenames([-i * step for i in range(1, reported + 1)])
+
+        for filename_ in filenames:
+            logging.error("Missing EPG: " + filename_)
+        if missing > reported:
+            logging.error("%i older missing EPGs were not reported." % (missing - reported))
+
+        def report():
+            for filename_ in filenames:
+                informer_ = self.informer.forEntity(getEntity(self.config, filename_))
+                informer_.get(epgComponent).failed()
+
+        self.missingEpgReport = threading.Thread(target=report)
+        self.missingEpgReport.daemon = True
+        self.missingEpgReport.start()
+
+
+    def finish(self):
+        """Wait for the missing EPGs of this run to be reported."""
+        if self.missingEpgReport:
+            self.missingEpgReport.join()
 
 
     def run(self):
@@ -118,7 +248,7 @@ class YouseeEpgDownloader():
         msgs = []
 
         # age related checks
-        epgAgeCheckComponent = informer.get(epgAgeCheck)
+        epgAgeCheckComponent = self.informer.get(epgAgeCheck)
         epgAgeCheckComponent.started()
         newestEpg = self.getNewestEpgFile()
 
@@ -136,12 +266,19 @@ class YouseeEpgDownloader():
 
         epgAgeCheckComponent.completed()
 
-        # download epg data into memory using wget
-        epgDownloadComponent = informer.get(epgDownload)
+        # stream epg data into a temporary file
+        epgDownloadComponent = self.informer.get(epgDownload)
         epgDownloadComponent.started()
-        newEpg = self.fetchEpg(filename)
+        fetchResult, newEpg = self.fetchEpg(self.filename, newestEpg)
 
-        if not newEpg:
+        if fetchResult == fetchNotModified:
+            msg = "EPG data not modified since the last download."
+            logging.info(msg)
+            msgs.append(msg)
+            epgDownloadComponent.completed(msg)
+            self.setOutcome(changed=False, md5sum=newestEpg.getMd5sum() if newestEpg else None)
+            return self.reportUnmodifiedEpg(newestEpg, epgTooOld, msgs, errors)
+        elif not newEpg:
             msg = "Failed to fetch EPG data."
             logging.error(msg)
             msgs.append(msg)
@@ -149,17 +286,58 @@ class YouseeEpgDownloader():
             errors += 1
             return msgs, errors
         else:
-            msg = "Fetched EPG data."
+            if fetchResult == fetchAborted:
+                msg = "Stopped fetching EPG data, the size check rejected it."
+            else:
+                msg = "Fetched EPG data."
             logging.info(msg)
             msgs.append(msg)
+            self.addBytes(epgDownload, newEpg.getSize())
+            self.setOutcome(size=newEpg.getSize())
             epgDownloadComponent.completed(msg)
 
+        try:
+            return self.checkAndSaveEpg(newEpg, newestEpg, epgTooOld, msgs, errors)
+        finally:
+            # clean up the temporary file, unless the data was persisted or trashed
+            newEpg.discard()
+
+
+    def reportUnmodifiedEpg(self, newestEpg, epgTooOld, msgs, errors):
+        """Report the states of the checks that were skipped, because the server said the EPG data was unchanged."""
+        for component in [epgSize, epgMd5]:
+            skippedComponent = self.informer.get(component)
+            skippedComponent.started()
+            skippedComponent.completed("Skipped, EPG data not modified.")
+
+        epgWriterComponent = self.informer.get(epgWriter)
+        epgWriterComponent.started()
+
+        if epgTooOld:
+            msg = "EPG haven't been updated in " + str(newestEpg.getAge())
+            logging.error(msg)
+            msgs.append(msg)
+            errors += 1
+            epgWriterComponent.failed(msg)
+        else:
+            msg = "Unchanged EPG data, didn't save."
+            logging.info(msg)
+            msgs.append(msg)
+            epgWriterComponent.completed(msg)
+
+        return msgs, errors
+
+
+    def checkAndSaveEpg(self, newEpg, newestEpg, epgTooOld, msgs, errors):
         # check size of the downloaded data
-        epgSizeComponent = informer.get(epgSize)
+        epgSizeComponent = self.informer.get(epgSize)
         epgSizeComponent.started()
 
         if not newEpg.fileSizeOK():
-            msg = "EPG data seems to have an unexpected size. Expected ~6.5MB, was %sMB." % newEpg.getPrettySize()
+            if newEpg.getSize() >= self.config.epgMaxSize:
+                msg = "EPG data seems to have an unexpected size. Expected ~6.5MB, was at least %sMB." % newEpg.getPrettySize()
+            else:
+                msg = "EPG data seems to have an unexpected size. Expected ~6.5MB, was %sMB." % newEpg.getPrettySize()
             logging.error(msg)
             msgs.append(msg)
             epgSizeComponent.failed(msg)
@@ -172,7 +350,7 @@ class YouseeEpgDownloader():
             epgSizeComponent.completed(msg)
 
         # get the md5sum of the downloaded data
-        epgMd5Component = informer.get(epgMd5)
+        epgMd5Component = self.informer.get(epgMd5)
         epgMd5Component.started()
         md5sum = newEpg.getMd5sum()
 
@@ -187,12 +365,48 @@ class YouseeEpgDownloader():
             msg = "md5sum: " + md5sum
             logging.info(msg)
             msgs.append(msg)
+            self.setOutcome(md5sum=md5sum)
             epgMd5Component.completed(msg)
 
+        # check that the downloaded data is well-formed xml; this was done while downloading,
+        # so invalid data can go straight to the trash, without ever being saved in the data directory
+        epgXmlComponent = self.informer.get(epgXml)
+        epgXmlComponent.started()
+        validXml = newEpg.isValidXml()
+
+        if not validXml:
+            xmlError = newEpg.getXmlError()
+            trashPath = newEpg.moveToTrash()
+            if trashPath:
+                msg = "Invalid XML (%s), moved to \"%s\"." % (xmlError, trashPath)
+            else:
+                msg = "Invalid XML (%s), but failed while moving the file to the trash." % xmlError
+            logging.error(msg)
+            msgs.append(msg)
+            epgXmlComponent.failed(msg)
+            errors += 1
+            return msgs, errors
+        else:
+            msg = "Valid XML."
+            logging.info(msg)
+            msgs.append(msg)
+            epgXmlComponent.completed(msg)
+
         # persist the downloaded data to disk
-        epgWriterComponent = informer.get(epgWriter)
+        epgWriterComponent = self.informer.get(epgWriter)
         epgWriterComponent.started()
+
+        if self.lease and not self.holdsLease():
+            msg = "Lost the lease on \"%s\" while downloading, didn't save." % self.config.dataDir
+            logging.error(msg)
+            msgs.append(msg)
+            epgWriterComponent.failed(msg)
+            errors += 1
+            return msgs, errors
+
         persisted = self.saveNewEpgData(newEpg)
+        if persisted is not None:
+            self.setOutcome(changed=persisted)
 
         if persisted is None:
             msg = "Something unexpected happened while deciding whether or not to keep the new file."
@@ -219,38 +433,256 @@ class YouseeEpgDownloader():
             msg = "Saved EPG data to file: " + newEpg.getPath()
             logging.info(msg)
             msgs.append(msg)
+            self.addBytes(epgWriter, newEpg.getSize())
             epgWriterComponent.completed(msg)
 
-        # run xmllint on the downloaded data
-        epgXmlComponent = informer.get(epgXml)
-        epgXmlComponent.started()
-        validXml = newEpg.isValidXml()
+        return msgs, errors
 
-        if not validXml:
-            trashPath = newEpg.moveToTrash()
-            if trashPath:
-                msg = "Invalid XML, moved to \"%s\"." % trashPath
-            else:
-                msg = "Invalid XML, but failed while moving the file to the trash."
-            logging.error(msg)
-            msgs.append(msg)
-            epgXmlComponent.failed(msg)
-            errors += 1
+
+def getEntity(config, filename):
+    """Get the state monitor entity for an EPG file. The files of a named feed are prefixed with the name of the feed."""
+    if config.feedName:
+        return "%s:%s" % (config.feedName, filename)
+    return filename
+
+
+def runDownloader(config, reporter, downloader=None):
+    """Download EPG data once, reporting to the state monitor through reporter.
+    Returns the exit code, and the downloader, which a long-running process
+    can pass to the next run. Only one run at a time can use a data directory;
+    if another run has it, this one is skipped, depending on RunLock. With a
+    lease, only the host holding it downloads.
+    """
+    filename = createFilename()
+    entity = getEntity(config, filename)
+    metrics = RunMetrics()
+    informer = StateInformer(entity, config.stateMonitor, reporter, metrics)
+    epgComponent_ = informer.get(epgComponent)
+
+    lock = RunLock(os.path.join(config.dataDir, runLockFilename), config.runLock, config.runLockTimeout, config.runLockStaleAfter)
+    try:
+        locked = lock.acquire()
+    except (IOError, OSError) as e:
+        epgComponent_.failed("Failed to lock the data directory: %s" % e)
+        raise
+
+    if not locked:
+        msg = "Another run is using \"%s\" (%s), skipped this one." % (config.dataDir, lock.describe(lock.getHolder()))
+        logging.warning(msg)
+        informer.get(epgRunLock).failed(msg)
+        return 5, downloader
+    elif lock.waited:
+        msg = "Waited %i seconds for another run to finish." % lock.waited
+        logging.info(msg)
+        informer.get(epgRunLock).completed(msg)
+
+    try:
+        lease = None
+        if config.lease:
+            lease = EpgLease(os.path.join(config.dataDir, leaseFilename), config.leaseHolder, config.leaseDuration, config.leaseGrace,
+                             config.leaseRenewGrace)
+            if not lease.acquire():
+                msg = "Standing by for \"%s\", %s." % (config.dataDir, lease.describe())
+                logging.info(msg)
+                informer.get(epgLease).completed(msg)
+                return 0, downloader
+
+        if downloader:
+            downloader.reset(informer, filename, lease)
+            logging.info("Reusing %s for \"%s\"." % (downloader.__class__.__name__, entity))
         else:
-            msg = "Valid XML."
-            logging.info(msg)
-            msgs.append(msg)
-            epgXmlComponent.completed(msg)
+            downloader = YouseeEpgDownloader(config, informer, filename, lease)
+            logging.info("Created new %s for \"%s\", using \"%s\" as state monitor." % (downloader.__class__.__name__, entity, config.stateMonitor))
+        epgComponent_.started()
+        (messages, errors) = downloader.run()
+    except Exception as e:
+        summary = metrics.getSummary()
+        epgComponent_.failed("%s\n%s" % (e.message, summary))
+        logging.error("Failed: %s" % entity)
+        if downloader:
+            downloader.finish()
+        recordRun(config, metrics, entity, 1, 1, summary)
+        raise
+    else:
+        downloader.finish()
+        summary = metrics.getSummary()
+        if errors > 0:
+            epgComponent_.failed("\n".join(messages + [summary]))
+            logging.error("Failed: %s" % entity)
+            exitCode = 4
+        else:
+            epgComponent_.done(summary)
+            logging.info("Done: %s" % entity)
+            exitCode = 0
+        logging.info(summary)
+        recordRun(config, metrics, entity, exitCode, errors, summary)
+        return exitCode, downloader
+    finally:
+        lock.release()
+
+
+def recordRun(config, metrics, entity, exitCode, errors, summary):
+    """Write the metrics of a run to MetricsDir, and add it to the HistoryFile, if set. Failing to do so doesn't fail the run."""
+    if config.metricsDir:
+        name = "yousee-epg-%s" % config.feedName if config.feedName else "yousee-epg"
+        try:
+            metrics.write(config.metricsDir, name, config.feedName, entity=entity, exitCode=exitCode, errors=errors, summary=summary)
+        except (IOError, OSError) as e:
+            logging.warning("Failed to write metrics to \"%s\": %s" % (config.metricsDir, e))
+
+    if config.historyFile:
+        stages = dict((column, metrics.getStageTime(stage)) for stage, column in historyColumns.items())
+        stages["state_monitor"] = metrics.getCallTime()[1]
+        outcome = metrics.outcome
+        try:
+            history = EpgHistory(config.historyFile)
+            try:
+                history.add(config.feedName, metrics.started, time.time() - metrics.started, exitCode, errors,
+                            outcome.get("changed"), outcome.get("size"), outcome.get("md5sum"), stages)
+            finally:
+                history.close()
+        except sqlite3.Error as e:
+            logging.warning("Failed to add the run to \"%s\": %s" % (config.historyFile, e))
+
+
+def runFeeds(config, reporter, downloaders=None):
+    """Run the downloader for every feed in config, at most FeedWorkers at a time.
+    Returns the highest exit code of the feeds, and their downloaders, for the next run.
+    """
+    downloaders = downloaders or [None] * len(config.feeds)
+
+    if len(config.feeds) == 1:
+        exitCode, downloader = runDownloader(config.feeds[0], reporter, downloaders[0])
+        return exitCode, [downloader]
+
+    def runFeed((feed, downloader)):
+        # one failing feed mustn't stop the others
+        try:
+            return runDownloader(feed, reporter, downloader)
+        except Exception:
+            logging.exception("Feed \"%s\" failed:" % feed.feedName)
+            return 1, None
 
-        return msgs, errors
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(config.feedWorkers, len(config.feeds)))
+    try:
+        results = pool.map(runFeed, zip(config.feeds, downloaders))
+    finally:
+        pool.close()
+
+    return max(exitCode for exitCode, downloader in results), [downloader for exitCode, downloader in results]
+
+
+class EpgDaemon():
+    """Runs the downloader for all feeds every EpgAgeLimit, give or take DaemonJitter seconds.
+    The config, the connections to the server and the state monitor, and what's
+    known about the newest EPG file are kept between runs. Runs never overlap;
+    if one takes longer than the interval, the next starts when it's done.
+    SIGTERM and SIGINT stop the daemon once the current run is done, and a
+    second signal stops it right away. SIGHUP starts a run right away.
+    With the "adaptive" DaemonSchedule, runs follow the times the EPG data
+    usually changes instead, see PublishSchedule, still at most EpgAgeLimit apart.
+    """
+
+    def __init__(self, config, reporter):
+        self.config = config
+        self.reporter = reporter
+        self.downloaders = None
+        # the feed with the shortest EpgAgeLimit decides how often to run
+        self.interval = min(feed.epgAgeLimit for feed in config.feeds)
+        self.stopping = False
+        self.wakeup = threading.Event()
+
+
+    def stop(self, signum, frame):
+        if self.stopping:
+            logging.warning("Got signal %i again, stopping now." % signum)
+            raise SystemExit(1)
+        logging.info("Got signal %i, stopping after the current run." % signum)
+        self.stopping = True
+        self.wakeup.set()
+
+
+    def runNow(self, signum, frame):
+        logging.info("Got signal %i, running now." % signum)
+        self.wakeup.set()
+
+
+    def getSchedule(self, feed, downloader):
+        """Learn when feed publishes from the files it saved in the last AdaptiveHistoryDays."""
+        since = time.time() - feed.adaptiveHistoryDays * 24 * 3600
+        times = getPublishTimes(feed, downloader.manifest if downloader else None, since)
+        return PublishSchedule(times, feed.epgAgeLimit.total_seconds(), feed.adaptivePollInterval, feed.adaptiveMargin, feed.adaptiveMinDays)
+
+
+    def getDelay(self, started):
+        """Get the number of seconds from now until the run after the one started at started."""
+        if self.config.daemonSchedule == "adaptive":
+            # the feed that needs a run first decides when all of them run
+            nextRuns = []
+            for feed, downloader in zip(self.config.feeds, self.downloaders or [None] * len(self.config.feeds)):
+                schedule = self.getSchedule(feed, downloader)
+                logging.info("%s: %s." % ("Feed \"%s\"" % feed.feedName if feed.feedName else "Schedule", schedule.describe()))
+                nextRuns.append(schedule.getNextRun(started))
+            return max(min(nextRuns) - time.time(), 0)
+
+        interval = self.interval.total_seconds()
+        jitter = random.uniform(-self.config.daemonJitter, self.config.daemonJitter)
+        return max(started + interval + jitter - time.time(), 0)
+
+
+    def serve(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGHUP, self.runNow)
+        if self.config.daemonSchedule == "adaptive":
+            logging.info("Started daemon, running around the times the EPG data changes, at least every %s." % self.interval)
+        else:
+            logging.info("Started daemon, running every %s." % self.interval)
+
+        while not self.stopping:
+            started = time.time()
+            if rotateLogs(self.config):
+                setupLogging(self.config)
+            # states spooled during earlier runs are sent while this one runs, once their backoff has passed
+            self.reporter.replay()
+
+            try:
+                exitCode, self.downloaders = runFeeds(self.config, self.reporter, self.downloaders)
+            except Exception:
+                logging.exception("Run failed:")
+            # send the states of this run before going to sleep
+            self.reporter.flush()
+
+            if not self.stopping:
+                delay = self.getDelay(started)
+                logging.info("Next run in %i seconds." % delay)
+                self.wakeup.wait(delay)
+                self.wakeup.clear()
+
+        logging.info("Stopped daemon.")
+
+
+def setupLogging(config):
+    """Log to config.logFile, reopening it if it's already open, e.g. after the log has been rotated."""
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    logging.basicConfig(filename=config.logFile,level=logging.INFO, format='%(asctime)s: %(message)s')
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print "Usage: %s config-file" % sys.argv[0]
+    commands = ["run", "daemon", "rebuild-manifest", "flush-spool", "stats"]
+
+    # only stats takes arguments, the windows to describe
+    if len(sys.argv) < 2 or sys.argv[2:] and sys.argv[2] not in commands or sys.argv[3:] and sys.argv[2] != "stats":
+        print "Usage: %s config-file [%s]" % (sys.argv[0], "|".join(commands))
+        print "       %s config-file stats [window ...], with windows like 12h, 7d, 4w or all (default 7d 30d all)" % sys.argv[0]
         sys.exit(1)
     else:
         configFile = sys.argv[1]
+        command = sys.argv[2] if len(sys.argv) >= 3 else "run"
 
     try:
         config = EpgConfig(configFile)
@@ -259,28 +691,57 @@ if __name__ == "__main__":
         raise
     else:
         rotateLogs(config)
-        logging.basicConfig(filename=config.logFile,level=logging.INFO, format='%(asctime)s: %(message)s')
-        filename = createFilename()
-        informer = StateInformer(filename, config.stateMonitor)
-        epgComponent_ = informer.get(epgComponent)
-        try:
-            downloader = YouseeEpgDownloader(config, informer, filename)
-            logging.info("Created new %s for \"%s\", using \"%s\" as state monitor." % (downloader.__class__.__name__, filename, config.stateMonitor))
-            epgComponent_.started()
-            (messages, errors) = downloader.run()
-        except Exception as e:
-            epgComponent_.failed(e.message)
-            logging.error("Failed: %s" % filename)
-            raise
-        else:
-            if errors > 0:
-                epgComponent_.failed("\n".join(messages))
-                logging.error("Failed: %s" % filename)
-                exitCode = 4
-            else:
-                epgComponent_.done()
-                logging.info("Done: %s" % filename)
-                exitCode = 0
-
+        setupLogging(config)
+
+        if command == "rebuild-manifest":
+            feeds = [feed for feed in config.feeds if feed.manifestFile]
+            if not feeds:
+                print "No ManifestFile configured in " + configFile
+                sys.exit(1)
+            for feed in feeds:
+                count = rebuildManifest(feed, EpgManifest(feed.manifestFile))
+                print "Indexed %i files in \"%s\"." % (count, feed.manifestFile)
+            sys.exit(0)
+
+        if command == "stats":
+            windows = sys.argv[3:] or ["7d", "30d", "all"]
+            if not config.historyFile or not os.path.exists(config.historyFile):
+                print "No HistoryFile configured, or no runs recorded yet, in " + configFile
+                sys.exit(1)
+            try:
+                map(parseWindow, windows)
+            except ValueError as e:
+                print e
+                sys.exit(1)
+            history = EpgHistory(config.historyFile)
+            print "\n".join(formatStats(history, windows))
+            history.close()
+            sys.exit(0)
+
+        if command == "flush-spool":
+            reporter = createStateReporter(config)
+            if not reporter.spool:
+                print "No StateMonitorSpoolFile configured in " + configFile
+                sys.exit(1)
+            sent = reporter.flushSpool()
+            reporter.close()
+            left = reporter.spool.count()
+            print "Sent %i states, %i left in \"%s\"." % (sent, left, config.stateMonitorSpoolFile)
+            sys.exit(0 if left == 0 else 4)
+
+        reporter = createStateReporter(config)
+        # states left over from earlier runs are sent while this one runs
+        reporter.replay()
+
+        if command == "daemon":
+            EpgDaemon(config, reporter).serve()
+            reporter.close()
             logging.shutdown()
-            sys.exit(exitCode)
+            sys.exit(0)
+
+        try:
+            exitCode, downloaders = runFeeds(config, reporter)
+        finally:
+            reporter.close()
+        logging.shutdown()
+        sys.exit(exitCode)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""Round trips through the delta format of epgdelta.py. Run with: python -m unittest discover tests"""
+
+import os, sys, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "lib"))
+from epgdelta import anchorLength, applyDelta, createDelta, deltaHeader
+
+
+def programmes(first, count, title="P"):
+    return "".join('<programme start="%i">\n<title>%s %i</title>\n</programme>\n' % (i, title, i) for i in range(first, first + count))
+
+
+class DeltaRoundTripTest(unittest.TestCase):
+    def assertRoundTrip(self, base, target):
+        delta = createDelta(base, target)
+        self.assertTrue(delta.startswith(deltaHeader))
+        self.assertEqual(applyDelta(base, delta), target)
+        return delta
+
+
+    def testEmpty(self):
+        self.assertEqual(self.assertRoundTrip("", ""), deltaHeader)
+        self.assertRoundTrip("", "<tv></tv>")
+        self.assertEqual(self.assertRoundTrip("<tv></tv>", ""), deltaHeader)
+
+
+    def testNoCommonTokens(self):
+        base = "<tv>" + programmes(0, 20, "A") + "</tv>"
+        target = "<schedule>" + programmes(100, 20, "B") + "</schedule>"
+        delta = self.assertRoundTrip(base, target)
+        self.assertNotIn("\nC ", delta)
+
+
+    def testNoTrailingBracket(self):
+        base = "<tv>" + programmes(0, 20) + "</tv>\ntrailing text"
+        self.assertRoundTrip(base, base)
+        self.assertRoundTrip(base, base[:-len("text")])
+        self.assertRoundTrip(base, base + " and more")
+        self.assertRoundTrip("no tags at all", "still no tags")
+
+
+    def testInsertedNewlines(self):
+        base = "<tv>\n" + programmes(0, 20) + "</tv>\n"
+        inserted = "<programme>\nI 5\nC 0 3\n\n</programme>\n"
+        target = base.replace(programmes(10, 1), inserted)
+        delta = self.assertRoundTrip(base, target)
+        # the inserted data looks like operations, and has to be skipped by its length
+        self.assertIn(inserted.rstrip("\n"), delta)
+        # only the changed programme is inserted, the rest is copied
+        self.assertIn("\nC ", delta)
+        self.assertLess(len(delta), len(target) // 2)
+
+
+    def testCopiesUnchangedRuns(self):
+        base = "<tv>" + programmes(0, 200) + "</tv>"
+        target = "<tv>" + programmes(10, 200) + "</tv>"
+        delta = self.assertRoundTrip(base, target)
+        self.assertLess(len(delta), len(programmes(200, 10)) + 100)
+
+
+    def testShortData(self):
+        # fewer tokens than an anchor can't be copied, only inserted
+        data = "<a>" * (anchorLength - 1)
+        self.assertRoundTrip(data, data)
+
+
+    def testNotADelta(self):
+        self.assertRaises(ValueError, applyDelta, "<tv/>", "I 3\nabc")
+
+
+if __name__ == "__main__":
+    unittest.main()